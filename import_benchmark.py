@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Import time of the inference entry point.
+
+Every scan job starts a fresh worker which imports romiseg.Segmentation2D
+before segmenting the first image. The import is run several times in fresh
+interpreters with python -X importtime, the median total time and the
+slowest modules are reported, and the check fails (exit code 1) if the time
+exceeds the budget or if a module only needed for training, plotting or the
+annotation GUI is imported:
+
+    python import_benchmark.py --budget 5 --output import_time.json
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+
+import numpy as np
+
+#not needed to segment images: imported by the functions using them only
+FORBIDDEN = ['tkinter', 'matplotlib', 'PyQt5', 'requests', 'appdirs',
+             'torch.utils.tensorboard', 'romiseg.utils.alienlab']
+
+
+def import_times(module):
+    """Imports module in a fresh interpreter, returns the self and cumulative
+    import times in seconds of every module imported"""
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+                         stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+    if out.returncode != 0:
+        raise RuntimeError(out.stderr.decode().strip().splitlines()[-1])
+    times = {}
+    for line in out.stderr.decode().splitlines():
+        #import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(own) / 1e6, int(cumulative) / 1e6)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import time of the inference entry point.')
+    parser.add_argument('--module', dest='module', default='romiseg.Segmentation2D')
+    parser.add_argument('--runs', dest='runs', type=int, default=5)
+    parser.add_argument('--budget', dest='budget', type=float, default=5.,
+                        help='maximum median import time in seconds')
+    parser.add_argument('--top', dest='top', type=int, default=15,
+                        help='number of slowest modules reported')
+    parser.add_argument('--output', dest='output', default=None)
+    args = parser.parse_args()
+
+    import_times(args.module) #warms the bytecode and file system caches
+    runs = [import_times(args.module) for i in range(args.runs)]
+    totals = [times[args.module][1] for times in runs]
+    total = float(np.median(totals))
+    last = runs[-1]
+    slowest = sorted(last.items(), key = lambda kv: kv[1][0], reverse = True)[:args.top]
+    forbidden = [f for f in FORBIDDEN if any(name == f or name.startswith(f + '.') for name in last)]
+
+    for name, (own, cumulative) in slowest:
+        print('%-50s %8.3fs self %8.3fs cumulative'%(name, own, cumulative))
+    print('import %s: %.3fs (median of %d runs), budget %.3fs'%(args.module, total, args.runs, args.budget))
+    if forbidden:
+        print('modules which should not be imported: %s' % ', '.join(forbidden))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'module': args.module, 'median': total, 'runs': totals, 'budget': args.budget,
+                       'forbidden': forbidden, 'modules': len(last),
+                       'slowest': [{'module': name, 'self': own, 'cumulative': cumulative}
+                                   for name, (own, cumulative) in slowest]}, f, indent = 2)
+
+    if total > args.budget or forbidden:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
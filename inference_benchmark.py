@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Inference benchmark of the segmentation network.
+
+ResNetUNet runs forward passes on synthetic input for every combination of
+encoder backbone, batch size, crop size, number of threads, precision,
+backend (eager torch, TorchScript or onnxruntime, see romiseg.utils.backends)
+and graph optimization (romiseg.utils.optimization).
+Each configuration runs in its own process, so that its peak resident memory
+is measured alone. Reports images/s, the p50/p90/p99 latency of a batch and the peak
+RSS, and writes them as JSON:
+
+    python inference_benchmark.py --backbones mobilenet_v2,resnet18,resnet50,resnet101 --batch_sizes 1,2,4 --crops 448,896 --threads 1,4 --precisions float32,bfloat16 --backends eager,torchscript,onnxruntime --optimize 0,1 --output benchmark.json
+
+Random weights are used unless a trained model is given with --weights and
+--model (the timings do not depend on the weights).
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+
+def run_config(config):
+    """Benchmarks one configuration in the current process, returns its results"""
+    import torch
+    from romiseg.utils.precision import autocast
+    from romiseg.utils.backends import to_backend
+    from romiseg.utils.optimization import optimize_for_inference
+    from romiseg.utils.segmentation_model import ResNetUNet
+
+    torch.set_num_threads(config['threads'])
+    torch.manual_seed(0)
+    if config.get('model'):
+        from romiseg.utils.train_from_dataset import load_model
+        model = load_model(os.path.join(config['weights'], config['model']), torch.device('cpu'))
+    else:
+        model = ResNetUNet(config['classes'], pretrained = False,
+                           backbone = config.get('backbone', 'resnet101')).eval()
+    backend = config.get('backend', 'eager')
+    if backend == 'onnxruntime' and config['precision'] != 'float32':
+        raise ValueError('the onnxruntime backend runs in float32 only')
+    model = to_backend(model, backend)
+    if config.get('optimize'):
+        model = optimize_for_inference(model)
+    inputs = torch.rand(config['batch_size'], 3, config['crop'], config['crop'])
+
+    latencies = []
+    with torch.no_grad(), autocast(config['precision'], 'cpu'):
+        for i in range(config['warmup'] + config['iterations']):
+            t0 = time.perf_counter()
+            model(inputs)
+            if i >= config['warmup']:
+                latencies.append(time.perf_counter() - t0)
+
+    latencies = np.array(latencies)
+    result = dict(config)
+    result.update({'images_per_second': config['batch_size'] * len(latencies) / latencies.sum(),
+                   'latency_mean': latencies.mean(),
+                   'latency_p50': np.percentile(latencies, 50),
+                   'latency_p90': np.percentile(latencies, 90),
+                   'latency_p99': np.percentile(latencies, 99),
+                   #kilobytes on Linux
+                   'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.})
+    return {k: float(v) if isinstance(v, np.floating) else v for k, v in result.items()}
+
+
+def run_subprocess(config, timeout = None):
+    """Benchmarks one configuration in a fresh interpreter"""
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), '--config', json.dumps(config)],
+                         stdout = subprocess.PIPE, stderr = subprocess.PIPE, timeout = timeout)
+    if out.returncode != 0:
+        result = dict(config)
+        lines = out.stderr.decode().strip().splitlines()
+        result['error'] = lines[-1] if lines else 'exit code %d' % out.returncode
+        return result
+    return json.loads(out.stdout.decode().strip().splitlines()[-1])
+
+
+def host_info():
+    import torch
+    return {'platform': platform.platform(), 'processor': platform.processor(),
+            'cpu_count': os.cpu_count(), 'python': platform.python_version(),
+            'torch': torch.__version__, 'mkldnn': torch.backends.mkldnn.is_available()}
+
+
+def int_list(s):
+    return [int(v) for v in s.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inference benchmark of the segmentation network.')
+    parser.add_argument('--batch_sizes', dest='batch_sizes', type=int_list, default=[1, 2, 4])
+    parser.add_argument('--crops', dest='crops', type=int_list, default=[448, 896],
+                        help='comma separated square crop sizes (multiples of 32)')
+    parser.add_argument('--threads', dest='threads', type=int_list, default=[os.cpu_count()],
+                        help='comma separated numbers of intra-op threads')
+    parser.add_argument('--precisions', dest='precisions', default='float32',
+                        help='comma separated precisions: float32, bfloat16')
+    parser.add_argument('--backbones', dest='backbones', default='resnet101',
+                        help='comma separated encoders of the random networks, see segmentation_model.BACKBONES')
+    parser.add_argument('--backends', dest='backends', default='eager',
+                        help='comma separated backends: eager, torchscript, onnxruntime')
+    parser.add_argument('--optimize', dest='optimize', type=int_list, default=[0],
+                        help='comma separated 0 (model as loaded) and/or 1 (optimize_for_inference)')
+    parser.add_argument('--classes', dest='classes', type=int, default=6)
+    parser.add_argument('--iterations', dest='iterations', type=int, default=10)
+    parser.add_argument('--warmup', dest='warmup', type=int, default=2)
+    parser.add_argument('--weights', dest='weights', default=None,
+                        help='folder of a trained model, random weights if not given')
+    parser.add_argument('--model', dest='model', default=None)
+    parser.add_argument('--timeout', dest='timeout', type=float, default=None,
+                        help='maximum duration of a configuration in seconds')
+    parser.add_argument('--output', dest='output', default='inference_benchmark.json')
+    parser.add_argument('--config', dest='config', default=None,
+                        help=argparse.SUPPRESS) #single configuration, run by the subprocesses
+    args = parser.parse_args()
+
+    if args.config is not None:
+        print(json.dumps(run_config(json.loads(args.config))))
+        return
+
+    results = []
+    for backbone, backend, optimize, precision, threads, crop, batch_size in itertools.product(
+            args.backbones.split(','), args.backends.split(','), args.optimize, args.precisions.split(','),
+            args.threads, args.crops, args.batch_sizes):
+        config = {'backbone': backbone, 'backend': backend, 'optimize': bool(optimize),
+                  'precision': precision, 'threads': threads,
+                  'crop': crop, 'batch_size': batch_size, 'classes': args.classes,
+                  'iterations': args.iterations, 'warmup': args.warmup,
+                  'weights': args.weights, 'model': args.model}
+        try:
+            result = run_subprocess(config, args.timeout)
+        except subprocess.TimeoutExpired:
+            result = dict(config, error = 'timeout')
+        results.append(result)
+        name = '%-12s %-11s %-9s %-8s %2d threads %4dpx batch %2d'%(backbone, backend,
+               'optimized' if optimize else '', precision, threads, crop, batch_size)
+        if 'error' in result:
+            print('%s: error %s'%(name, result['error']))
+        else:
+            print('%s: %7.2f images/s, p50 %.3fs p90 %.3fs p99 %.3fs, %.0f MB'%(
+                  name, result['images_per_second'], result['latency_p50'],
+                  result['latency_p90'], result['latency_p99'], result['peak_rss_mb']))
+
+    with open(args.output, 'w') as f:
+        json.dump({'host': host_info(), 'results': results}, f, indent = 2)
+    print('results written in %s' % args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -38,6 +38,7 @@ from romidata import fsdb
 
 from romiseg.utils.train_3D import train_model_voxels
 from romiseg.utils.dataloader_finetune import plot_dataset
+from romiseg.utils.image_decode import crop_array
 from romiseg.utils import segmentation_model
 
 import romiseg.utils.vox_to_coord as vtc
@@ -79,6 +80,7 @@ epochs = param2['epochs']
 batch_size = param2['batch']
 
 learning_rate = param2['learning_rate']
+precision = param2.get('precision', 'float32') #'bfloat16' for mixed precision forward passes
 
 
 param3 = param_pipe['Reconstruction3D']
@@ -114,20 +116,24 @@ def init_set(mode, path):
 class Dataset_im_label_3D(Dataset): 
     """Data handling for Pytorch Dataloader"""
 
-    def __init__(self, image_paths, label_paths, voxel_path, transform):  
+    def __init__(self, image_paths, label_paths, voxel_path, transform, crop = None):  
 
         self.image_paths = image_paths
         self.label_paths = label_paths
         self.voxel_path = voxel_path
         self.transforms = transform
+        self.crop = crop #crop = (Sx, Sy): center crop by slicing, without PIL round trip
 
     def __getitem__(self, index):
 
         db_file = self.image_paths[index]
-        image = Image.fromarray(io.read_image(db_file))
-        #id_im = db_file.id
-        t_image = self.transforms(image) #crop the images
-        t_image = t_image[0:3, :, :] #select RGB channels
+        if self.crop is None:
+            image = Image.fromarray(io.read_image(db_file))
+            t_image = self.transforms(image) #crop the images
+            t_image = t_image[0:3, :, :] #select RGB channels
+        else:
+            #uint8, converted to float per batch by train_model_voxels
+            t_image = crop_array(np.asarray(io.read_image(db_file)), self.crop)
         
         db_file = self.label_paths[index]
         npz = io.read_npz(db_file)
@@ -194,8 +200,8 @@ image_val, target_val, voxel_val = init_set('', path_val)
 
 
     
-train_dataset = Dataset_im_label_3D(image_train, target_train, voxel_train, transform = trans)
-val_dataset = Dataset_im_label_3D(image_val, target_val, voxel_val, transform = trans) 
+train_dataset = Dataset_im_label_3D(image_train, target_train, voxel_train, transform = trans, crop = (Sx, Sy))
+val_dataset = Dataset_im_label_3D(image_val, target_val, voxel_val, transform = trans, crop = (Sx, Sy)) 
         
 train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=batch_size, shuffle=True, num_workers=1)
 
@@ -256,7 +262,7 @@ new_model_name = model_segmentation_name + ext_name
 
 if False:
     model = train_model_voxels('Segmentation', dataloaders, model, optimizer_ft, exp_lr_scheduler, writer, voxel_loss, voxels,
-                        num_epochs = epochs, viz = True, label_names = label_names)
+                        num_epochs = epochs, viz = True, label_names = label_names, precision = precision)
         
     #model[0].save_state_dict(directory_weights + '/' + new_model_name)
     torch.save(model, directory_weights + '/' + new_model_name)
@@ -280,7 +286,7 @@ print(model.class_layer[0].weight.data)
 
 model = train_model_voxels('Fullpipe', dataloaders, model, optimizer_ft, exp_lr_scheduler,
                            writer, voxel_loss, voxels,
-                    num_epochs = epochs, viz = True, label_names = label_names)
+                    num_epochs = epochs, viz = True, label_names = label_names, precision = precision)
 
 #save model
 model_name =  model_segmentation_name + os.path.split(directory_dataset)[1] + '_epoch%d.pt'%epochs
@@ -8,33 +8,44 @@ Created on Mon Jul  8 16:17:15 2019
 #computer vision
 import torch
 from torch.utils.data import DataLoader, Dataset
-from torchvision import transforms
-import appdirs
 from tqdm import tqdm
 from PIL import Image
-from tkinter import filedialog
-
-#import appdirs
 
 #made in CSL
-from romidata import io
+from romidata import io, fsdb
 from romiseg.utils.train_from_dataset import evaluate, save_and_load_model
-from romiseg.utils.alienlab import create_folder_if
+from romiseg.utils.tiling import tiled_predict
+from romiseg.utils.precision import prediction_dtype, prediction_scale, quantize_predictions
+from romiseg.utils.image_metadata import bucket_by_size, fileset_image_size
+from romiseg.utils.image_decode import read_rgb, to_float_batch
+from romiseg.utils.result_cache import get_result_cache
+from romiseg.utils.foreground import channel_maxima, foreground_mask, has_foreground
+from romiseg.utils.profiling import profiler
+from romiseg.utils import weights_store
 
 class Dataset_im_id(Dataset): 
-    """Data handling for Pytorch Dataloader"""
+    """Data handling for Pytorch Dataloader.
+    Without transform, only the center crop of size crop = (Sx, Sy) of the images is decoded
+    (whole images if crop is None), downscaled by scale, and returned as uint8 tensors, see
+    to_float_batch"""
 
-    def __init__(self, image_paths, transform):  
+    def __init__(self, image_paths, transform = None, crop = None, scale = 1):  
 
         self.image_paths = image_paths
         self.transforms = transform
+        self.crop = crop
+        self.scale = scale
 
     def __getitem__(self, index):
 
         db_file = self.image_paths[index]
-        image = Image.fromarray(io.read_image(db_file))
         id_im = db_file.id
         
+        if self.transforms is None:
+            with profiler.stage('decode', 1):
+                return read_rgb(fsdb._file_path(db_file), self.crop, self.scale), id_im
+
+        image = Image.fromarray(io.read_image(db_file))
         t_image = self.transforms(image) #crop the images
         
         t_image = t_image[0:3, :, :] #select RGB channels
@@ -44,60 +55,275 @@ class Dataset_im_id(Dataset):
     def __len__(self):  # return count of sample
         return len(self.image_paths)
 
-def segmentation(Sx, Sy, label_names, images_fileset, scan, model_segmentation_name, directory_weights):
-        """Inputs a set of N_cam images of an object from different points of view and segmentes the images in N_label classes, 
-        pixel per pixel.
-        Outputs a matrix of size [N_cam, N_labels, xinit, yinit].
-        Sx and Sy are chosen by the user to center-crop the image and lighten
-        the computational cost. The neural network should be trained on RGB images of size Sx,Sy.
+def prediction_size(xinit, yinit, scale = 1, upsample = True, **options):
+        """Size of the predictions of [xinit, yinit] images segmented with options"""
+        if upsample or scale == 1:
+            return xinit, yinit
+        return int(round(xinit * scale)), int(round(yinit * scale))
+
+def load_segmentation_model(directory_weights, model_segmentation_name, device = None, backend = None,
+                            optimize = False, precision = 'float32', **options):
+        """Network used by segmentation() with the same options (other options are ignored), taken
+        from the model registry: calling it beforehand keeps the model loading out of timings"""
+        if device is None:
+            device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+        #the graph optimizations are traced in float32, mixed precision keeps the eager model
+        return save_and_load_model(directory_weights, model_segmentation_name, device, backend = backend,
+                                   optimize = optimize and backend != 'eager' and precision in (None, 'float32'))
+
+def _segment(Sx, Sy, images_fileset, model_segmentation_name, directory_weights, xinit, yinit, acquire,
+             batch_size = 1, num_workers = 0, prefetch_factor = 2, precision = 'float32',
+             tiling = False, tile_size = None, tile_overlap = 0.25, tile_blending = 'gaussian',
+             scale = 1, upsample = True, foreground_filter = False, foreground_threshold = 0.15,
+             foreground_min_pixels = 64, backend = None, optimize = False):
+        """Runs the segmentation network over the [xinit, yinit] images of images_fileset (see
+        segmentation for the options).
+        The prediction of image number index is written in the [N_labels, prediction_size(...)]
+        zero-initialized buffer acquire(index), quantized to the dtype of the buffer.
+        Yields (index, image id) when the prediction of an image is complete.
         """
+        if tiling and scale != 1 and upsample:
+            raise ValueError('tiled segmentation at scale %g requires upsample = False'%scale)
+        if tiling:
+            if tile_size is None:
+                tile_size = (Sx, Sy)
+            #five poolings in the UNet
+            if tile_size[0] % 32 or tile_size[1] % 32:
+                raise ValueError('the tile size %dx%d should be a multiple of 32'%tuple(tile_size))
+            #tile_overlap is a fraction of the tile
+            if not 0 <= tile_overlap < 1:
+                raise ValueError('tile_overlap should be in [0, 1), got %g'%tile_overlap)
+        elif round(Sx * scale) % 32 or round(Sy * scale) % 32:
+            raise ValueError('the scaled crop %gx%g should be a multiple of 32'%(Sx * scale, Sy * scale))
+        if backend == 'onnxruntime' and precision not in (None, 'float32'):
+            raise ValueError('the onnxruntime backend runs in float32 only, got precision %s'%precision)
 
         device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu") #Select GPU
         print(device, ' used for images segmentation')
         
-        trans = transforms.Compose([ #Define transform of the image
-                transforms.CenterCrop((Sx, Sy)),
-                transforms.ToTensor()])
-        
-        #PyTorch Dataloader
-        image_set = Dataset_im_id(images_fileset, transform = trans) 
-        batch_size = 1       
-        loader = DataLoader(image_set, batch_size=batch_size, shuffle=False, num_workers=0)
+        #PyTorch Dataloader, decoding only the center crop (full images when tiling, cut in tiles later)
+        image_set = Dataset_im_id(images_fileset, crop = None if tiling else (Sx, Sy), scale = scale) 
+        loader_options = {}
+        if num_workers > 0:
+            #bounded queue between the decoding workers and the forward pass
+            loader_options['prefetch_factor'] = prefetch_factor
+        loader = DataLoader(image_set, batch_size=batch_size, shuffle=False, num_workers=num_workers,
+                            pin_memory=(device.type == 'cuda'), **loader_options)
         #Access the previously trained segmenttion network stored in db.romi-project.eu
+        model_segmentation = load_segmentation_model(directory_weights, model_segmentation_name, device,
+                                                     backend, optimize, precision)
+        #uint8 batches are converted to float on the device
+        #at reduced scale, the logits are upsampled to the crop size unless upsample is False
+        size = (Sx, Sy) if upsample and not tiling else None
+        def predict(inputs):
+            with profiler.stage('transform', len(inputs)):
+                inputs = to_float_batch(inputs, device)
+            with profiler.stage('forward', len(inputs)):
+                return evaluate(inputs, model_segmentation, precision, size).cpu()
+        px, py = prediction_size(xinit, yinit, scale, upsample)
         
-        #Save folder
-        #directory_weights = appdirs.user_cache_dir()
-        
-        #directory_weights = '/home/alienor/Documents/database/WEIGHTS'
-        #if directory_weights == 'complete here':
-        #   directory_weights = filedialog.askdirectory(initialdir="/home/", title='create folder to save fine-tuning weights')
-        #   create_folder_if(directory_weights)
+        #vegetation pre-filter: crops or tiles without plant pixels skip the network
+        skipped = [0, 0] #skipped, total
+        def _keep(images, maxima = None):
+            with profiler.stage('foreground', len(images) if images.dim() == 4 else 1):
+                kept = has_foreground(foreground_mask(images, foreground_threshold, maxima),
+                                      foreground_min_pixels)
+            skipped[0] += int((~kept).sum())
+            skipped[1] += kept.numel()
+            return kept
+        keep = _keep if foreground_filter else None
+        def keep_tiles(image):
+            #tiles are scored with the channel maxima of their whole image
+            maxima = channel_maxima(image)
+            return lambda tile: bool(keep(tile, maxima))
+
+        with torch.no_grad():
+            if tiling:
+                print('Image segmentation by the CNN, %dx%d tiles'%tuple(tile_size))
+                #predictions are blended directly in the output buffers
+                yield from tiled_predict(loader, predict, (px, py), tile_size, acquire,
+                                         tile_overlap, tile_blending, batch_size,
+                                         None if keep is None else keep_tiles)
+                if foreground_filter:
+                    print('foreground filter: %d of %d tiles skipped'%tuple(skipped))
+                return
+
+            print('Image segmentation by the CNN')
+            #corner of the crop in the predictions
+            x0, y0 = (xinit-Sx)//2, (yinit-Sy)//2
+            if (px, py) != (xinit, yinit):
+                x0, y0 = int(round(x0 * scale)), int(round(y0 * scale))
+            cx, cy = prediction_size(Sx, Sy, scale, upsample) #size of the crop in the predictions
+            index = 0
+            for inputs, id_im in loader:
+                outputs = [None] * len(id_im) #None: background
+                selected = list(range(len(id_im))) if keep is None else keep(inputs).nonzero()[:, 0].tolist()
+                if selected:
+                    if len(selected) < len(id_im):
+                        inputs = inputs[selected]
+                    for j, pred in zip(selected, predict(inputs)):  #output image
+                        outputs[j] = pred
+                for pred, i in zip(outputs, id_im):
+                    out = acquire(index)
+                    #reverse the crop in order to match the colmap parameters
+                    with profiler.stage('padding', 1):
+                        if pred is None:
+                            out[0,x0:x0+cx,y0:y0+cy] = prediction_scale(out.dtype)
+                        else:
+                            out[:,x0:x0+cx,y0:y0+cy] = quantize_predictions(pred, out.dtype)
+                    yield index, i
+                    index += 1
+            if foreground_filter:
+                print('foreground filter: %d of %d crops skipped'%tuple(skipped))
+
+
+def _cached_segment(Sx, Sy, label_names, images_fileset, model_segmentation_name, directory_weights,
+                    xinit, yinit, acquire, result_cache = None, pred_dtype = 'float32', **options):
+        """_segment going through the result cache (a ResultCache or a directory, see
+        romiseg.utils.result_cache): the predictions found in the cache are copied in acquire(index),
+        the other images are segmented and their predictions stored. Yields (index, image id) in the
+        order of images_fileset.
+        """
+        cache = get_result_cache(result_cache)
+        if cache is None:
+            yield from _segment(Sx, Sy, images_fileset, model_segmentation_name, directory_weights,
+                                xinit, yinit, acquire, **options)
+            return
+
+        weights_path = weights_store.resolve(directory_weights, model_segmentation_name) #downloads if needed
+        context = cache.context(weights_path, Sx, Sy, label_names,
+                                pred_dtype = str(prediction_dtype(pred_dtype)), **options)
+        keys = [cache.key(fsdb._file_path(db_file), context) for db_file in images_fileset]
+        #only the keys are looked up here, the cached predictions are loaded one by one when yielded
+        misses = [index for index, key in enumerate(keys) if not cache.contains(key)]
+        print('result cache: %d hits, %d misses'%(len(keys) - len(misses), len(misses)))
+
+        def segment(indices, acquire_index):
+            return _segment(Sx, Sy, [images_fileset[i] for i in indices], model_segmentation_name,
+                            directory_weights, xinit, yinit, acquire_index, **options)
+
+        def copy_hit(i):
+            pred = cache.get(keys[i])
+            if pred is None: #evicted or truncated since the lookup
+                for _ in segment([i], lambda j: acquire(i)):
+                    pass
+                cache.put(keys[i], acquire(i))
+            else:
+                acquire(i).copy_(pred)
+            return i, images_fileset[i].id
+
+        computed = segment(misses, lambda j: acquire(misses[j])) if misses else []
+        position = 0 #next index to yield
+        for j, id_im in computed:
+            index = misses[j]
+            for i in range(position, index):
+                yield copy_hit(i)
+            cache.put(keys[index], acquire(index))
+            yield index, id_im
+            position = index + 1
+        for i in range(position, len(images_fileset)):
+            yield copy_hit(i)
+
+
+def segmentation_stream(Sx, Sy, label_names, images_fileset, scan, model_segmentation_name, directory_weights,
+                        pred_dtype = 'float32', return_index = False, **options):
+        """Generator version of segmentation: yields (image id, prediction) view by view, the prediction
+        being a [N_labels, xinit, yinit] tensor. Only the views in flight are held in memory.
+        Takes the same options as segmentation.
+        The views are yielded in the order of images_fileset. If the images have different sizes, they
+        are segmented by groups of same size, in the order of the first image of each group: use 
+        return_index = True to get (index in images_fileset, image id, prediction) instead.
+        """
+        dtype = prediction_dtype(pred_dtype)
+        for (xinit, yinit), bucket in bucket_by_size(images_fileset).items():
+            indices = [index for index, _ in bucket]
+            px, py = prediction_size(xinit, yinit, **options)
+            buffers = {}
+            def acquire(index):
+                if index not in buffers:
+                    buffers[index] = torch.zeros((len(label_names), px, py), dtype = dtype)
+                return buffers[index]
+            
+            for index, id_im in _cached_segment(Sx, Sy, label_names, [db_file for _, db_file in bucket],
+                                                model_segmentation_name, directory_weights, xinit, yinit,
+                                                acquire, pred_dtype = pred_dtype, **options):
+                if return_index:
+                    yield indices[index], id_im, buffers.pop(index)
+                else:
+                    yield id_im, buffers.pop(index)
+
+
+def segmentation(Sx, Sy, label_names, images_fileset, scan, model_segmentation_name, directory_weights,
+                 sink = None, pred_dtype = 'float32', **options):
+        """Inputs a set of N_cam images of an object from different points of view and segmentes the images in N_label classes, 
+        pixel per pixel.
+        Outputs a matrix of size [N_cam, N_labels, xinit, yinit].
+        Sx and Sy are chosen by the user to center-crop the image and lighten
+        the computational cost. The neural network should be trained on RGB images of size Sx,Sy.
         
-        model_segmentation = save_and_load_model(directory_weights, model_segmentation_name)
+        If sink is given, sink(image_id, prediction) is called for each view as soon as its
+        [N_labels, xinit, yinit] prediction is ready, the dense matrix is never built and None is
+        returned in its place (see also segmentation_stream). Otherwise all the images must have the
+        same size.
         
-    
-        #GET ORIGINAL IMAGE SIZE and number(could be in image metadata instead)    
-        s = io.read_image(images_fileset[0]).shape
-        xinit = s[0] 
-        yinit = s[1]
+        Options:
+        batch_size images go through the network in one forward pass. With num_workers > 0 the images
+        are decoded and cropped by worker processes, at most prefetch_factor batches per worker ahead 
+        of the network, so that image I/O overlaps with inference.
+        precision = 'bfloat16' runs the network under autocast with bfloat16 convolutions (fast on
+        recent x86 CPUs), the predictions are still returned in float32 before storage.
+        With tiling = True the images are not cropped: the full images are segmented by a sliding
+        window of size tile_size (default (Sx, Sy)) with tile_overlap overlap between tiles, blended
+        with tile_blending weights ('uniform', 'linear' or 'gaussian'), batch_size tiles per forward pass.
+        The whole image is then predicted, Sx = xinit and Sy = yinit should be used downstream.
+        pred_dtype ('float32', 'float16' or 'uint8') is the storage type of the predictions, uint8
+        probabilities range from 0 to 255 (see romiseg.utils.precision for the accuracy bounds).
+        result_cache (a directory or a romiseg.utils.result_cache.ResultCache) keeps the predictions
+        on disk, keyed by the content of the images and of the weights, Sx, Sy, label_names and the
+        options: images already segmented with the same parameters are neither decoded nor segmented
+        again. The hit and miss counters are in get_result_cache(result_cache).stats().
+        With scale < 1 the crop is downscaled by scale (decoded at reduced resolution for JPEG images)
+        before the forward pass, and the logits are bilinearly upsampled back to Sx, Sy. With
+        upsample = False the predictions are kept at low resolution: the output is then
+        [N_cam, N_labels, round(xinit * scale), round(yinit * scale)], to be used with the intrinsics
+        rescaled by romiseg.utils.vox_to_coord.scale_intrinsics (Sx, Sy, xinit and yinit downstream
+        are to be multiplied by scale as well). Tiled segmentation at reduced scale requires
+        upsample = False, the tiles are then cut from the downscaled images.
+        With foreground_filter = True, the excess green index of the crops (or of the tiles, with
+        the channel maxima of their whole image) is computed before the network (see romiseg.utils.foreground): the crops with less than
+        foreground_min_pixels pixels above foreground_threshold are not segmented, they get the
+        prediction of the first label (background) with probability 1.
+        backend ('eager', 'torchscript' or 'onnxruntime', see romiseg.utils.backends) converts the
+        network at load time, None runs it as stored in the weights file (.pt, .ts or .onnx). The
+        onnxruntime backend runs on CPU in float32.
+        With optimize = True an eager network is run as an optimized frozen graph, with the batch
+        norms folded, channels last layout and fused Conv2d + ReLU (see romiseg.utils.optimization),
+        unless backend = 'eager' is asked or precision is not float32. The optimization takes
+        seconds at each model load and the folded weights are a private copy, not shared with the
+        other processes through the memory-mapped weights file: it pays off for long-lived workers.
+        The decode, transform, forward and padding stages are timed by romiseg.utils.profiling.profiler.
+        """
+        id_list = []
+        if sink is not None:
+            for id_im, pred in tqdm(segmentation_stream(Sx, Sy, label_names, images_fileset, scan,
+                                                        model_segmentation_name, directory_weights,
+                                                        pred_dtype, **options),
+                                    total = len(images_fileset)):
+                sink(id_im, pred)
+                id_list.append([id_im])
+            return None, id_list
+
+        #GET ORIGINAL IMAGE SIZE (from the file headers) and number
+        xinit, yinit = fileset_image_size(images_fileset)
         N_cam = len(images_fileset)
-       
-        
-        
-        with torch.no_grad():
-            pred_tot = []
-            id_list = []
-            count = 0
-            print('Image segmentation by the CNN')
         
-            for inputs, id_im in tqdm(loader):
-                inputs = inputs.to(device) #input image on GPU
-                outputs = evaluate(inputs, model_segmentation)  #output image
-                pred_tot.append(outputs)
-                id_list.append(id_im)
-                count += 1
-        pred_tot = torch.cat(pred_tot, dim = 0)
-        pred_pad = torch.zeros((N_cam, len(label_names), xinit, yinit)) #reverse the crop in order to match the colmap parameters
-        pred_pad[:,:,(xinit-Sx)//2:(xinit+Sx)//2,(yinit-Sy)//2:(yinit+Sy)//2] = pred_tot #To fit the camera parameters
+        #the predictions are written straight in the output tensor
+        px, py = prediction_size(xinit, yinit, **options)
+        pred_pad = torch.zeros((N_cam, len(label_names), px, py), dtype = prediction_dtype(pred_dtype))
+        id_list = [None] * N_cam
+        for index, id_im in tqdm(_cached_segment(Sx, Sy, label_names, images_fileset, model_segmentation_name,
+                                                 directory_weights, xinit, yinit, lambda i: pred_pad[i],
+                                                 pred_dtype = pred_dtype, **options), total = N_cam):
+            id_list[index] = [id_im] #one entry per image, as with batch_size = 1
         
         return pred_pad, id_list
@@ -1 +1,7 @@
-from .Segmentation2D import segmentation
+def __getattr__(name):
+    #torch and the network are imported at first use of romiseg.segmentation,
+    #not when a submodule (romiseg.utils...) is imported
+    if name == 'segmentation':
+        from .Segmentation2D import segmentation
+        return segmentation
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Exports a trained segmentation network to a frozen TorchScript archive or to
+ONNX, that can be given to segmentation() in place of the pickled model:
+
+    python export_model.py --weights WEIGHTS_FOLDER --model MODEL_NAME.pt
+
+writes WEIGHTS_FOLDER/MODEL_NAME.ts, and with --format onnx
+WEIGHTS_FOLDER/MODEL_NAME.onnx (dynamic batch size and image size, run by
+onnxruntime). --format state_dict converts a pickled model to the weights
+store format of romiseg.utils.weights_store (state_dict and JSON sidecar,
+WEIGHTS_FOLDER/MODEL_NAME.pth and MODEL_NAME.pth.json).
+"""
+
+import argparse
+import os
+
+import torch
+
+from romiseg.utils.train_from_dataset import save_and_load_model
+from romiseg.utils.export import export_torchscript, export_onnx
+from romiseg.utils.weights_store import save_weights
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export a segmentation network to TorchScript, ONNX or a state_dict.')
+    parser.add_argument('--weights', dest='weights', required=True,
+                        help='folder of the model weights')
+    parser.add_argument('--model', dest='model', required=True,
+                        help='name of the model in the weights folder')
+    parser.add_argument('--output', dest='output', default=None,
+                        help='output file, default: model name with a .ts, .onnx or .pth extension')
+    parser.add_argument('--Sx', dest='Sx', type=int, default=896)
+    parser.add_argument('--Sy', dest='Sy', type=int, default=896)
+    parser.add_argument('--format', dest='format', default='torchscript', choices=['torchscript', 'onnx', 'state_dict'])
+    parser.add_argument('--method', dest='method', default='trace', choices=['trace', 'script'],
+                        help='TorchScript conversion')
+    parser.add_argument('--opset', dest='opset', type=int, default=17, help='ONNX opset version')
+    args = parser.parse_args()
+
+    output = args.output
+    if output is None:
+        extension = {'torchscript': '.ts', 'onnx': '.onnx', 'state_dict': '.pth'}[args.format]
+        output = os.path.join(args.weights, os.path.splitext(args.model)[0] + extension)
+
+    model = save_and_load_model(args.weights, args.model, torch.device('cpu'), cache = False)
+    if args.format == 'onnx':
+        export_onnx(model, output, args.Sx, args.Sy, args.opset)
+        print('ONNX model saved in %s' % output)
+    elif args.format == 'state_dict':
+        save_weights(model, output)
+        print('state_dict saved in %s' % output)
+    else:
+        export_torchscript(model, output, args.Sx, args.Sy, args.method)
+        print('TorchScript model saved in %s' % output)
+
+
+if __name__ == '__main__':
+    main()
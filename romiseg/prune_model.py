@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Structured channel pruning of the decoder of a trained segmentation network
+(see romiseg.utils.pruning). The channels are ranked on images of a scan of
+a FSDB, the pruned network is fine-tuned on the soft masks of the original
+one, saved in the weights store format, usable by segmentation() like any
+other model, and compared to the original network (FLOPs, forward time,
+agreement of the label maps and, with --ground_truth, IoU of both networks
+against the annotated label maps of the scan):
+
+    python prune_model.py --weights WEIGHTS_FOLDER --model MODEL_NAME.pt --db DB_PATH --scan SCAN_ID --ratio 0.5 --ground_truth images
+"""
+
+import argparse
+import json
+import os
+
+import torch
+
+from romidata import fsdb
+
+from romiseg.quantize_model import evaluation_set
+from romiseg.utils.train_from_dataset import save_and_load_model
+from romiseg.utils.pruning import prune_model, count_flops, DEFAULT_LAYERS, PRUNABLE
+from romiseg.utils.weights_store import save_weights
+from romiseg.utils.evaluation import compare_models, print_report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prune the decoder of a segmentation network.')
+    parser.add_argument('--weights', dest='weights', required=True,
+                        help='folder of the model weights')
+    parser.add_argument('--model', dest='model', required=True,
+                        help='name of the model in the weights folder')
+    parser.add_argument('--db', dest='db', required=True,
+                        help='FSDB holding the calibration scan')
+    parser.add_argument('--scan', dest='scan', required=True,
+                        help='id of the calibration scan')
+    parser.add_argument('--fileset', dest='fileset', default='images')
+    parser.add_argument('--labels', dest='labels', default='background,flower,peduncle,stem,leaf,fruit',
+                        help='comma separated label names')
+    parser.add_argument('--Sx', dest='Sx', type=int, default=896)
+    parser.add_argument('--Sy', dest='Sy', type=int, default=896)
+    parser.add_argument('--ratio', dest='ratio', type=float, default=0.5,
+                        help='fraction of the channels removed from each pruned block')
+    parser.add_argument('--layers', dest='layers', default=','.join(DEFAULT_LAYERS),
+                        help='comma separated blocks to prune, among %s' % ','.join(PRUNABLE))
+    parser.add_argument('--calibration', dest='calibration', type=int, default=8,
+                        help='number of images used to rank the channels and fine-tune')
+    parser.add_argument('--evaluation', dest='evaluation', type=int, default=8,
+                        help='number of images used to compare the original and pruned models')
+    parser.add_argument('--ground_truth', dest='ground_truth', default=None,
+                        help='fileset of the scan holding the ground truth (segmentation channel), e.g. images')
+    parser.add_argument('--steps', dest='steps', type=int, default=100,
+                        help='fine-tuning iterations, 0 to skip the fine-tuning')
+    parser.add_argument('--lr', dest='lr', type=float, default=1e-4)
+    parser.add_argument('--output', dest='output', default=None,
+                        help='output file, default: model name with a _pruned.pth extension')
+    args = parser.parse_args()
+
+    output = args.output
+    if output is None:
+        output = os.path.join(args.weights, os.path.splitext(args.model)[0] + '_pruned.pth')
+    label_names = args.labels.split(',')
+
+    db = fsdb.FSDB(args.db)
+    db.connect()
+    calibration, evaluation, targets = evaluation_set(db.get_scan(args.scan), args.fileset, args.calibration,
+                                                      args.evaluation, (args.Sx, args.Sy), args.ground_truth)
+    db.disconnect()
+
+    model = save_and_load_model(args.weights, args.model, torch.device('cpu'), cache = False)
+    pruned = prune_model(model, calibration, args.ratio, args.layers.split(','), args.steps, args.lr)
+    save_weights(pruned, output, label_names = label_names)
+    print('pruned model saved in %s' % output)
+
+    report = compare_models(model, pruned, evaluation, label_names, targets = targets)
+    report['reference_flops'] = count_flops(model, args.Sx, args.Sy)
+    report['candidate_flops'] = count_flops(pruned, args.Sx, args.Sy)
+    report['widths'] = pruned.widths
+    print('GFLOPs per image: %.1f, reference %.1f'%(report['candidate_flops'] / 1e9,
+                                                     report['reference_flops'] / 1e9))
+    print_report(report, 'pruned')
+    with open(os.path.splitext(output)[0] + '_report.json', 'w') as f:
+        json.dump(report, f, indent = 2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Post-training int8 quantization of a trained segmentation network for CPU
+nodes. The activation ranges are calibrated on images of a scan of a FSDB,
+the quantized network is saved as a TorchScript archive, usable by
+segmentation() like any other model, and compared to the float network
+(agreement of the label maps and, with --ground_truth, IoU of both networks
+against the annotated label maps of the scan):
+
+    python quantize_model.py --weights WEIGHTS_FOLDER --model MODEL_NAME.pt --db DB_PATH --scan SCAN_ID --ground_truth images
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from romidata import fsdb, io
+
+from romiseg.Segmentation2D import Dataset_im_id
+from romiseg.utils.train_from_dataset import save_and_load_model
+from romiseg.utils.quantization import quantize_model
+from romiseg.utils.export import export_torchscript
+from romiseg.utils.evaluation import compare_models, print_report
+from romiseg.utils.image_decode import to_float_batch, crop_box
+
+
+def scan_images(scan, fileset_name = 'images'):
+    """RGB images of a scan"""
+    files = scan.get_fileset(fileset_name).get_files()
+    return [f for f in files if f.get_metadata('channel') in (None, 'rgb')]
+
+
+def ground_truth_labels(fileset, image, crop = None):
+    """Label map [Sx, Sy] of the center crop of the ground truth of image: the 'segmentation'
+    channel file of fileset with the same shot_id, one mask per label after the background (as
+    read by train_cnn). None if the image has no ground truth."""
+    files = fileset.get_files({'shot_id': image.get_metadata('shot_id'), 'channel': 'segmentation'})
+    if not files:
+        return None
+    npz = io.read_npz(files[0])
+    masks = torch.stack([torch.from_numpy(np.asarray(npz[k]) > 0) for k in npz.files]).float()
+    background = (masks.sum(dim = 0) == 0).float().unsqueeze(0)
+    labels = torch.argmax(torch.cat([background, masks]), dim = 0)
+    x0, y0, x1, y1 = crop_box(labels.shape[0], labels.shape[1], crop)
+    return labels[x0:x1, y0:y1]
+
+
+def evaluation_set(scan, fileset_name, n_calibration, n_evaluation, crop, ground_truth = None):
+    """Float batches of n_calibration calibration images and n_evaluation evaluation images spread
+    over the views of the scan, and the ground truth label maps of the evaluation batches read
+    from the fileset ground_truth (None: no ground truth)"""
+    images = scan_images(scan, fileset_name)
+    #calibration and evaluation images are spread over the views of the scan
+    n = n_calibration + n_evaluation
+    images = [images[i * len(images) // n] for i in range(min(n, len(images)))]
+    image_set = Dataset_im_id(images, crop = crop)
+    batches = [to_float_batch(inputs) for inputs, _ in DataLoader(image_set, batch_size = 1)]
+    calibration = batches[0::2][:n_calibration]
+    evaluation = batches[1::2][:n_evaluation]
+    evaluation_images = images[1::2][:n_evaluation]
+    if not evaluation:
+        evaluation, evaluation_images = calibration, images[0::2][:n_calibration]
+    targets = None
+    if ground_truth is not None:
+        fileset = scan.get_fileset(ground_truth)
+        targets = [ground_truth_labels(fileset, image, crop) for image in evaluation_images]
+        targets = [None if t is None else t.unsqueeze(0) for t in targets]
+        print('ground truth found for %d of %d evaluation images'%(sum(t is not None for t in targets),
+                                                                   len(targets)))
+    return calibration, evaluation, targets
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Quantize a segmentation network to int8.')
+    parser.add_argument('--weights', dest='weights', required=True,
+                        help='folder of the model weights')
+    parser.add_argument('--model', dest='model', required=True,
+                        help='name of the float model in the weights folder')
+    parser.add_argument('--db', dest='db', required=True,
+                        help='FSDB holding the calibration scan')
+    parser.add_argument('--scan', dest='scan', required=True,
+                        help='id of the calibration scan')
+    parser.add_argument('--fileset', dest='fileset', default='images')
+    parser.add_argument('--labels', dest='labels', default='background,flower,peduncle,stem,leaf,fruit',
+                        help='comma separated label names')
+    parser.add_argument('--Sx', dest='Sx', type=int, default=896)
+    parser.add_argument('--Sy', dest='Sy', type=int, default=896)
+    parser.add_argument('--calibration', dest='calibration', type=int, default=8,
+                        help='number of calibration images')
+    parser.add_argument('--evaluation', dest='evaluation', type=int, default=8,
+                        help='number of images used to compare the float and int8 models')
+    parser.add_argument('--ground_truth', dest='ground_truth', default=None,
+                        help='fileset of the scan holding the ground truth (segmentation channel), e.g. images')
+    parser.add_argument('--engine', dest='engine', default=None,
+                        help='quantized kernels: x86, fbgemm or qnnpack (ARM)')
+    parser.add_argument('--output', dest='output', default=None,
+                        help='output file, default: model name with an _int8.ts extension')
+    args = parser.parse_args()
+
+    output = args.output
+    if output is None:
+        output = os.path.join(args.weights, os.path.splitext(args.model)[0] + '_int8.ts')
+    label_names = args.labels.split(',')
+
+    db = fsdb.FSDB(args.db)
+    db.connect()
+    calibration, evaluation, targets = evaluation_set(db.get_scan(args.scan), args.fileset, args.calibration,
+                                                      args.evaluation, (args.Sx, args.Sy), args.ground_truth)
+    db.disconnect()
+
+    model = save_and_load_model(args.weights, args.model, torch.device('cpu'), cache = False)
+    quantized = quantize_model(model, calibration, args.engine)
+    export_torchscript(quantized, output, args.Sx, args.Sy)
+    print('int8 model saved in %s' % output)
+
+    report = compare_models(model, quantized, evaluation, label_names, targets = targets)
+    print_report(report, 'int8')
+    with open(os.path.splitext(output)[0] + '_report.json', 'w') as f:
+        json.dump(report, f, indent = 2)
+
+
+if __name__ == '__main__':
+    main()
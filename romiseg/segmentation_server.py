@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Starts the segmentation service (see romiseg.utils.server):
+
+    python segmentation_server.py --socket /tmp/romiseg.sock --weights WEIGHTS_FOLDER
+
+Jobs are then sent with romiseg.utils.server.submit(socket_path, job). The
+server connects to the DB of each job, so the client must not keep that DB
+connected (romidata lock) while its job runs.
+"""
+
+import argparse
+
+from romiseg.utils.server import SegmentationServer
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Segmentation service over a Unix socket.')
+    parser.add_argument('--socket', dest='socket', default='/tmp/romiseg.sock',
+                        help='path of the Unix socket')
+    parser.add_argument('--weights', dest='weights', required=True,
+                        help='folder of the model weights')
+    parser.add_argument('--batch_size', dest='batch_size', type=int, default=4)
+    parser.add_argument('--num_workers', dest='num_workers', type=int, default=0,
+                        help='image decoding processes')
+    parser.add_argument('--max_merge', dest='max_merge', type=int, default=8,
+                        help='maximum number of scans segmented together')
+    args = parser.parse_args()
+
+    server = SegmentationServer(args.socket, args.weights, args.max_merge,
+                                batch_size = args.batch_size, num_workers = args.num_workers)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -27,8 +27,10 @@ import torch.optim as optim
 from romidata import io
 from romidata import fsdb
 
-from romiseg.utils.train_from_dataset import train_model
+from romiseg.utils.train_from_dataset import train_model, load_teacher
 from romiseg.utils.dataloader_finetune import plot_dataset
+from romiseg.utils.image_decode import crop_array
+from romiseg.utils.weights_store import save_weights
 from romiseg.utils import segmentation_model
 
 
@@ -66,6 +68,12 @@ epochs = param2['epochs']
 batch_size = param2['batch']
 
 learning_rate = param2['learning_rate']
+backbone = param2.get('backbone', 'resnet101') #see segmentation_model.BACKBONES
+precision = param2.get('precision', 'float32') #'bfloat16' for mixed precision forward passes
+#distillation: trained model of directory_weights whose soft masks are learnt along with the labels
+teacher_name = param2.get('teacher', '')
+distill_alpha = param2.get('distill_alpha', 0.5)
+distill_temperature = param2.get('distill_temperature', 1.)
 
 
 
@@ -100,21 +108,23 @@ def init_set(mode, path):
 class Dataset_im_label(Dataset): 
     """Data handling for Pytorch Dataloader"""
 
-    def __init__(self, image_paths, label_paths, transform):  
+    def __init__(self, image_paths, label_paths, transform, crop = None):  
 
         self.image_paths = image_paths
         self.label_paths = label_paths
         self.transforms = transform
+        self.crop = crop #crop = (Sx, Sy): center crop by slicing, without PIL round trip
 
     def __getitem__(self, index):
 
         db_file = self.image_paths[index]
-        image = Image.fromarray(io.read_image(db_file))
-        #id_im = db_file.id
-        t_image = transforms.ColorJitter(brightness=0, contrast=0, saturation=0, hue=0)(image)
-        t_image = self.transforms(image) #crop the images
-        
-        t_image = t_image[0:3, :, :] #select RGB channels
+        if self.crop is None:
+            image = Image.fromarray(io.read_image(db_file))
+            t_image = self.transforms(image) #crop the images
+            t_image = t_image[0:3, :, :] #select RGB channels
+        else:
+            #float here, the noise augmentation below needs it
+            t_image = crop_array(np.asarray(io.read_image(db_file)), self.crop).float().div_(255)
         
         db_file = self.label_paths[index]
         npz = io.read_npz(db_file)
@@ -179,9 +189,9 @@ image_train, target_train = init_set('', path_train)
 image_val, target_val = init_set('', path_val)
 image_test, target_test = init_set('', path_test)
 
-train_dataset = Dataset_im_label(image_train, target_train, transform = trans)
-val_dataset = Dataset_im_label(image_val, target_val, transform = trans) 
-test_dataset = Dataset_im_label(image_test, target_test, transform = trans)
+train_dataset = Dataset_im_label(image_train, target_train, transform = trans, crop = (Sx, Sy))
+val_dataset = Dataset_im_label(image_val, target_val, transform = trans, crop = (Sx, Sy)) 
+test_dataset = Dataset_im_label(image_test, target_test, transform = trans, crop = (Sx, Sy))
 
 train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=batch_size, shuffle=True, num_workers=1)
 
@@ -213,7 +223,7 @@ for child in  a[0].children():
    
 
       
-model = segmentation_model.ResNetUNet(num_classes).to(device)
+model = segmentation_model.ResNetUNet(num_classes, backbone = backbone).to(device)
 
 # freeze backbone layers
 for l in model.base_layers:
@@ -226,12 +236,17 @@ optimizer_ft = optim.Adam(filter(lambda p: p.requires_grad, model.parameters()),
 #make learning rate evolve
 exp_lr_scheduler = lr_scheduler.StepLR(optimizer_ft, step_size=30, gamma=0.1)
 
+teacher = None
+if teacher_name:
+    teacher = load_teacher(directory_weights, teacher_name, device)
+
 #Run training
 model = train_model(dataloaders, model, optimizer_ft, exp_lr_scheduler, writer, 
-                    num_epochs = epochs, viz = True, label_names = label_names)
+                    num_epochs = epochs, viz = True, label_names = label_names, precision = precision,
+                    teacher = teacher, distill_alpha = distill_alpha, distill_temperature = distill_temperature)
 #save model
 model_name =  model_segmentation_name + os.path.split(directory_dataset)[1] +'_%d_%d'%(Sx,Sy)+ '_epoch%d.pt'%epochs
-torch.save(model, directory_weights + '/' + model_name)
+save_weights(model, directory_weights + '/' + model_name, label_names = label_names)
 
 '''
     return model, model_name
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Inference backends of the segmentation networks.
+
+The same network can be run by
+  -'eager': the torch modules (pickled models)
+  -'torchscript': a frozen TorchScript graph (traced in memory from a pickled
+   model, or loaded from a .ts archive, see romiseg.utils.export)
+  -'onnxruntime': an onnxruntime session on CPU (exported in memory from a
+   pickled or TorchScript model, or loaded from a .onnx file)
+All the backends are called like the torch model: a float32 [N, 3, H, W]
+tensor in, float [N, N_labels, H, W] logits out, on the device of the input.
+With backend = None the weights file decides: pickled models run in eager
+mode, .ts archives with TorchScript and .onnx files with onnxruntime.
+
+onnxruntime is only imported when the onnxruntime backend is used.
+"""
+
+import io
+import os
+
+import torch
+
+from romiseg.utils.export import to_torchscript, export_onnx
+
+
+BACKENDS = ('eager', 'torchscript', 'onnxruntime')
+
+#the networks are fully convolutional: the graphs traced on a small input run on any
+#size multiple of 32
+_EXAMPLE_SIZE = 64
+
+
+class OnnxRuntimeModel(object):
+    """onnxruntime session behaving as the torch model"""
+
+    def __init__(self, model, threads = None):
+        """model: ONNX file name or serialized model (bytes)
+        threads: intra-op threads, default torch.get_num_threads()"""
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError('the onnxruntime backend requires the onnxruntime package')
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = threads or torch.get_num_threads()
+        self.session = onnxruntime.InferenceSession(model, options, providers = ['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        self.output_name = self.session.get_outputs()[0].name
+        #for the model registry
+        self.nbytes = len(model) if isinstance(model, bytes) else os.path.getsize(model)
+
+    def __call__(self, inputs):
+        logits = self.session.run([self.output_name],
+                                  {self.input_name: inputs.detach().float().cpu().contiguous().numpy()})[0]
+        return torch.from_numpy(logits).to(inputs.device)
+
+    def eval(self):
+        return self
+
+
+def model_backend(model):
+    """Backend running a loaded model"""
+    if isinstance(model, OnnxRuntimeModel):
+        return 'onnxruntime'
+    if isinstance(model, torch.jit.ScriptModule):
+        return 'torchscript'
+    return 'eager'
+
+
+def to_backend(model, backend = None, device = 'cpu'):
+    """Converts a loaded model (see train_from_dataset.load_model) to backend, on device.
+    backend = None keeps the model as it is. A TorchScript model cannot go back to eager mode
+    and an ONNX model can only run on onnxruntime: ValueError."""
+    if backend is None:
+        return model
+    if backend not in BACKENDS:
+        raise ValueError('backend should be one of %s, got %s'%(list(BACKENDS), backend))
+    current = model_backend(model)
+    if backend == current:
+        return model
+    if BACKENDS.index(backend) < BACKENDS.index(current):
+        raise ValueError('a %s model cannot run on the %s backend'%(current, backend))
+
+    if backend == 'torchscript':
+        module = to_torchscript(model, _EXAMPLE_SIZE, _EXAMPLE_SIZE)
+        if torch.device(device).type == 'cpu':
+            module = torch.jit.optimize_for_inference(module)
+        return module
+
+    #onnxruntime on CPU, the outputs are moved back to the device of the inputs
+    buffer = io.BytesIO()
+    export_onnx(model.cpu(), buffer, _EXAMPLE_SIZE, _EXAMPLE_SIZE)
+    return OnnxRuntimeModel(buffer.getvalue())
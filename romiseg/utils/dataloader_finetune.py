@@ -16,7 +16,7 @@ import numpy as np
 from PIL import Image
 import random
 
-import romiseg.utils.alienlab as alien
+from romiseg.utils.image_decode import read_rgb, crop_box, crop_array
 
 
 
@@ -30,15 +30,22 @@ def init_set(mode, path, ext = "png"):
 
 
 class Dataset_im_label(Dataset):
+    """Images and labels for training. If crop = (Sx, Sy) is the size of the center crop of
+    transform, only the region of the images that can end up in the crop is decoded
+    (the crop itself, or the disk it covers when rotating) and the images are returned
+    as uint8 tensors (see romiseg.utils.image_decode.to_float_batch)"""
 
-    def __init__(self, image_paths, target_paths, transform, rotate_bool = True):   # initial logic happens like transform
+    def __init__(self, image_paths, target_paths, transform, rotate_bool = True, crop = None):   # initial logic happens like transform
 
         self.image_paths = image_paths
         self.target_paths = target_paths
         self.transforms = transform
         self.rotate_bool = rotate_bool
+        self.crop = crop
 
     def __getitem__(self, index):
+        if self.crop is not None:
+            return self.read_crop(index)
         image = Image.open(self.image_paths[index])
         mask = Image.open(self.target_paths[index])
         if self.rotate_bool == True:     
@@ -60,7 +67,30 @@ class Dataset_im_label(Dataset):
     def __len__(self):  # return count of sample we have
 
         return len(self.image_paths)
-    
+
+    def read_crop(self, index):
+        '''uint8 center crop of the image, decoding only the region that can end up in
+        the crop, and its one hot encoded label'''
+        mask = Image.open(self.target_paths[index])
+        width, height = mask.size
+        Sx, Sy = self.crop
+        Rx, Ry = Sx, Sy
+        if self.rotate_bool == True:
+            #square containing the disk circumscribed to the crop, same parity as the crop
+            d = int(np.ceil(np.hypot(Sx, Sy)))
+            Rx, Ry = d + (d - Sx) % 2, d + (d - Sy) % 2
+        Rx, Ry = min(Rx, height), min(Ry, width)
+        x0, y0, x1, y1 = crop_box(height, width, (Rx, Ry))
+        t_image = read_rgb(self.image_paths[index], (Rx, Ry))
+        mask = mask.crop((y0, x0, y1, x1))
+        if self.rotate_bool == True:
+            angle = random.randint(0,360)
+            image = Image.fromarray(t_image.permute(1, 2, 0).numpy()).rotate(angle)
+            t_image = crop_array(np.array(image), (Sx, Sy))
+            mask = mask.rotate(angle)
+        t_mask = self.read_label(self.transforms(mask), self.target_paths[index])
+        return t_image, t_mask
+
     def read_label(self, im, name):
         '''This function reads the binary-encoded label of the input image and
         returns the one hot encoded label. 6 classes: 5 plan organs and ground'''
@@ -86,6 +116,7 @@ class Dataset_im_label(Dataset):
     
 
 def plot_dataset(train_loader, label_names, batch_size, showit = True):
+    import romiseg.utils.alienlab as alien #matplotlib and Qt, only needed to plot
     all_data = next(iter(train_loader))
     images = all_data[0]
     label = all_data[1]
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Comparison of a transformed segmentation network (quantized, pruned,
+rescaled...) with its reference: speed and agreement of the label maps, and
+IoU of both networks against ground truth label maps when available.
+"""
+
+import time
+
+import torch
+
+
+def label_map(outputs):
+    """Label of each pixel: class of highest score, [N, N_labels, W, H] -> [N, W, H]"""
+    return torch.argmax(outputs, dim = 1)
+
+
+def iou_counts(pred, ref, n_class):
+    """Intersection and union counts per class of two label maps"""
+    inter = torch.zeros(n_class, dtype = torch.long)
+    union = torch.zeros(n_class, dtype = torch.long)
+    for c in range(n_class):
+        p = pred == c
+        r = ref == c
+        inter[c] = (p & r).sum()
+        union[c] = (p | r).sum()
+    return inter, union
+
+
+def iou_from_counts(inter, union):
+    """IoU per class, None for the classes absent from both label maps"""
+    return [float(i) / float(u) if u > 0 else None for i, u in zip(inter, union)]
+
+
+def time_forward(model, inputs, repeat = 3, warmup = 1):
+    """Mean wall time in seconds of a forward pass of model on inputs"""
+    with torch.no_grad():
+        for _ in range(warmup):
+            model(inputs)
+        t0 = time.perf_counter()
+        for _ in range(repeat):
+            model(inputs)
+    return (time.perf_counter() - t0) / repeat
+
+
+def mean_iou(iou):
+    """Mean of the per-class IoU over the classes present, None if there are none"""
+    valid = [v for v in iou if v is not None]
+    return sum(valid) / len(valid) if valid else None
+
+
+def compare_models(reference, candidate, batches, label_names, repeat = 1, targets = None):
+    """Runs both models on the input batches.
+    Returns a report with the mean forward time of each model, the speedup of the candidate
+    and the per-class agreement of the label maps: IoU of the candidate label maps against the
+    reference label maps.
+    targets: optional ground truth label maps [N, W, H] of the batches (None for the batches
+    without ground truth), the per-class IoU of both models against them is added to the report.
+    """
+    n_class = len(label_names)
+    counts = {name: [torch.zeros(n_class, dtype = torch.long), torch.zeros(n_class, dtype = torch.long)]
+              for name in ('agreement', 'reference', 'candidate')}
+    def count(name, pred, ref):
+        i, u = iou_counts(pred, ref, n_class)
+        counts[name][0] += i
+        counts[name][1] += u
+    if targets is None:
+        targets = [None] * len(batches)
+    t_ref = 0
+    t_cand = 0
+    with torch.no_grad():
+        for inputs, target in zip(batches, targets):
+            t_ref += time_forward(reference, inputs, repeat)
+            t_cand += time_forward(candidate, inputs, repeat)
+            ref_labels = label_map(reference(inputs))
+            cand_labels = label_map(candidate(inputs))
+            count('agreement', cand_labels, ref_labels)
+            if target is not None:
+                count('reference', ref_labels, target)
+                count('candidate', cand_labels, target)
+    agreement = iou_from_counts(*counts['agreement'])
+    report = {'reference_time': t_ref / len(batches),
+              'candidate_time': t_cand / len(batches),
+              'speedup': t_ref / t_cand,
+              'agreement': dict(zip(label_names, agreement)),
+              'mean_agreement': mean_iou(agreement)}
+    if any(target is not None for target in targets):
+        for name in ('reference', 'candidate'):
+            iou = iou_from_counts(*counts[name])
+            report[name + '_iou'] = dict(zip(label_names, iou))
+            report[name + '_mean_iou'] = mean_iou(iou)
+    return report
+
+
+def print_report(report, title = 'candidate'):
+    print('%s: %.3fs per batch, reference %.3fs, speedup x%.2f'%(title, report['candidate_time'],
+          report['reference_time'], report['speedup']))
+    format_iou = lambda iou: '-' if iou is None else '%.4f'%iou
+    ground_truth = 'candidate_iou' in report
+    print(('    %-17s %-10s%s'%('class', 'agreement', '  IoU reference  IoU %s'%title if ground_truth else '')).rstrip())
+    for name, agreement in report['agreement'].items():
+        line = '    %-17s %-10s'%(name, format_iou(agreement))
+        if ground_truth:
+            line += '  %-13s  %s'%(format_iou(report['reference_iou'][name]), format_iou(report['candidate_iou'][name]))
+        print(line.rstrip())
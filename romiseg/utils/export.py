@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Export of the segmentation networks to TorchScript and ONNX.
+
+A TorchScript archive holds the weights and the graph of the network: it is
+loaded with torch.jit.load without unpickling the romiseg model classes and
+runs without the Python overhead of the eager modules.
+
+An ONNX file is run by onnxruntime (see romiseg.utils.backends), its batch
+and spatial axes are dynamic: one file serves every batch size and crop size.
+"""
+
+import inspect
+import os
+import zipfile
+
+import torch
+
+
+def export_torchscript(model, model_path, Sx = 896, Sy = 896, method = 'trace'):
+    """Converts model to a frozen TorchScript module saved in model_path.
+    method: 'trace' (records the operations run on a [1, 3, Sx, Sy] input) or 'script' (compiles
+    the python code of the forward pass)
+    Returns the exported module.
+    """
+    module = to_torchscript(model, Sx, Sy, method)
+    torch.jit.save(module, model_path)
+    return module
+
+
+def to_torchscript(model, Sx = 896, Sy = 896, method = 'trace'):
+    """Frozen TorchScript module of model, see export_torchscript"""
+    model = model.eval()
+    with torch.no_grad():
+        if method == 'trace':
+            param = next(model.parameters(), None) #quantized models have no float parameters
+            example = torch.rand(1, 3, Sx, Sy, device = 'cpu' if param is None else param.device)
+            module = torch.jit.trace(model, example)
+        elif method == 'script':
+            module = torch.jit.script(model)
+        else:
+            raise ValueError('unknown export method: %s' % method)
+        module = torch.jit.freeze(module)
+    return module
+
+
+def export_onnx(model, model_path, Sx = 896, Sy = 896, opset = 17):
+    """Exports model to ONNX in model_path (a file name or a binary file object), traced on a
+    [1, 3, Sx, Sy] input. The input 'images' [N, 3, H, W] and output 'logits' [N, N_labels, H, W]
+    have dynamic N, H and W (H and W multiples of 32)."""
+    model = model.eval()
+    param = next(model.parameters(), None)
+    example = torch.rand(1, 3, Sx, Sy, device = 'cpu' if param is None else param.device)
+    axes = {0: 'batch', 2: 'height', 3: 'width'}
+    options = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        #the TorchScript based exporter handles dynamic_axes and is much faster on the UNet
+        options['dynamo'] = False
+    with torch.no_grad():
+        torch.onnx.export(model, example, model_path, input_names = ['images'], output_names = ['logits'],
+                          dynamic_axes = {'images': axes, 'logits': axes}, opset_version = opset, **options)
+
+
+def is_onnx(model_path):
+    """True if model_path is an ONNX file (by its extension)"""
+    return os.path.splitext(model_path)[1].lower() == '.onnx'
+
+
+def is_torchscript(model_path):
+    """True if model_path is a TorchScript archive (and not a pickled model)"""
+    if not zipfile.is_zipfile(model_path):
+        return False
+    with zipfile.ZipFile(model_path) as archive:
+        return any(name.split('/')[1:2] == ['code'] for name in archive.namelist())
+
+
+def load_torchscript(model_path, device = 'cpu', optimize = True):
+    """Loads a TorchScript archive on device, in eval mode.
+    On CPU, optimize applies torch.jit.optimize_for_inference (operator fusion, oneDNN kernels).
+    This is done at load time because the optimized graph cannot be saved.
+    """
+    module = torch.jit.load(model_path, map_location = device).eval()
+    if optimize and torch.device(device).type == 'cpu':
+        module = torch.jit.optimize_for_inference(module)
+    return module
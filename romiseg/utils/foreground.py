@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Vegetation pre-filter of the segmentation.
+
+Most of a scanner image is background (turntable, backdrop). The excess
+green index of active_contour.exgreen is computed on the decoded images,
+before the network: the crops or tiles without enough plant pixels are not
+segmented by the network, their prediction is set to the background label.
+The channels are normalized by their maxima over the whole image, a tile
+is scored with the maxima of its image (see channel_maxima).
+"""
+
+
+def channel_maxima(images):
+    """Maximum of each channel of RGB images [..., 3, W, H]: [..., 3] float tensor"""
+    return images.float().amax(dim = (-2, -1))
+
+
+def exgreen(images, dark = 0.1, maxima = None):
+    """Excess green index 3 g / (r + g + b) - 1 of uint8 or float RGB images [..., 3, W, H], each
+    channel being normalized by its maximum over the image (as in active_contour.exgreen).
+    maxima [..., 3] (see channel_maxima) are given when images are tiles of larger images.
+    Pixels darker than dark (sum of the normalized channels) are set to -1."""
+    images = images.float()
+    if maxima is None:
+        maxima = channel_maxima(images)
+    norm = images / maxima[..., None, None].clamp(min = 1e-6)
+    luminance = norm.sum(dim = -3)
+    index = 3 * norm[..., 1, :, :] / luminance.clamp(min = 1e-6) - 1
+    index[luminance < dark] = -1
+    return index
+
+
+def foreground_mask(images, threshold = 0.15, maxima = None):
+    """Plant pixels of RGB images [..., 3, W, H]: boolean mask [..., W, H]"""
+    return exgreen(images, maxima = maxima) > threshold
+
+
+def has_foreground(mask, min_pixels = 64):
+    """True if a mask [W, H] (or each mask of a batch [N, W, H]) has at least min_pixels plant pixels"""
+    return mask.flatten(-2).sum(dim = -1) >= min_pixels
@@ -21,6 +21,7 @@ from romiseg.utils.train_from_dataset import train_model
 from romiseg.utils.dataloader_finetune import plot_dataset
 from romiseg.utils import segmentation_model
 from romiseg.utils.ply import write_ply
+from romiseg.utils.profiling import profiler
 
 import romiseg.utils.vox_to_coord as vtc
 import romiseg.utils.generate_3D_ground_truth as gt_vox
@@ -135,7 +136,7 @@ def read_extrinsics(images_fileset, N_cam):
 
 
 def build_voxel_volume(scan, coord_file_loc, extrinsics, intrinsics, min_vox, max_vox, num_vox, N_cam  = 72, cloud_scale = 2,
-                       Sx= 896, Sy = 896, xinit = 896, yinit = 896, label_num = 6):
+                       Sx= 896, Sy = 896, xinit = 896, yinit = 896, label_num = 6, chunk_size = None):
     #Voxel representation of the point cloud
     basis_voxels = vtc.basis_vox_pipeline(min_vox, max_vox, num_vox[0], num_vox[1], num_vox[2])#List of coordinates  
     
@@ -143,29 +144,22 @@ def build_voxel_volume(scan, coord_file_loc, extrinsics, intrinsics, min_vox, ma
 
     #Camera projection
     torch_voxels = torch.from_numpy(basis_voxels)    
+    n_vox = torch_voxels.shape[0]
 
-    #Perspective projection
-    xy_coords = vtc.project_coordinates(torch_voxels, intrinsics, extrinsics, give_prod = False)
-
-    #permute x and y coordinates
-    xy_coords[:, 2, :] = xy_coords[:,0,:]
-    xy_coords[:, 0, :] = xy_coords[:,1,:]
-    xy_coords[:, 1, :] = xy_coords[:,2,:]
-    
-
-    coords = vtc.correct_coords_outside(xy_coords, Sx, Sy, xinit, yinit, -1) #correct the coordinates that project outside
+    #Perspective projection, by chunks of chunk_size voxels (default vtc.CHUNK_SIZE)
     the_shape = torch.Size([N_cam, xinit, yinit, label_num])
-    xy_full_flat = vtc.flatten_coordinates(coords, the_shape)
-
-    volume = scan.get_fileset('volume', create=True)
-    coord_file = volume.get_file('coords', create=True)
-    io.write_torch(coord_file, xy_full_flat)
-    voxel_file = volume.get_file('voxels', create=True)
-    io.write_torch(voxel_file, torch_voxels)
-    torch.save(xy_full_flat, coord_file_loc + '/coords.pt')
-    torch.save(torch_voxels, coord_file_loc + '/voxels.pt')
+    xy_full_flat = vtc.project_flat_coordinates(torch_voxels, intrinsics, extrinsics, the_shape, Sx, Sy, xinit, yinit,
+                                                chunk_size = chunk_size)
+
+    with profiler.stage('volume_write', n_vox):
+        volume = scan.get_fileset('volume', create=True)
+        coord_file = volume.get_file('coords', create=True)
+        io.write_torch(coord_file, xy_full_flat)
+        voxel_file = volume.get_file('voxels', create=True)
+        io.write_torch(voxel_file, torch_voxels)
+        torch.save(xy_full_flat, coord_file_loc + '/coords.pt')
+        torch.save(torch_voxels, coord_file_loc + '/voxels.pt')
     del xy_full_flat
-    del coords
     
     return torch_voxels
 
@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Content hashes of files, shared by the weights store (integrity of the
+weights) and the result cache (keys of the predictions).
+"""
+
+import hashlib
+import os
+import threading
+
+
+_digests = {} #(path, mtime, size) -> sha256
+_digests_lock = threading.Lock()
+
+
+def file_digest(path, chunk_size = 2**20):
+    """sha256 of the content of a file, memoized by path, modification time and size"""
+    st = os.stat(path)
+    key = (os.path.realpath(path), st.st_mtime_ns, st.st_size)
+    with _digests_lock:
+        if key in _digests:
+            return _digests[key]
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    digest = h.hexdigest()
+    with _digests_lock:
+        _digests[key] = digest
+    return digest
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Image dimensions without decoding the images.
+
+The size of a scan image is read from the header of the image file (PIL only
+parses the header until the pixels are accessed), or from the camera model
+stored in its FSDB metadata if the header cannot be read. Sizes are cached
+per file so that a fileset is probed once per process.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+
+_sizes = {} #(file path, mtime) -> (xinit, yinit)
+_lock = threading.Lock()
+
+
+def _file_path(db_file):
+    from romidata import fsdb
+    return fsdb._file_path(db_file)
+
+
+def _metadata_size(db_file):
+    """(height, width) of the camera model in the metadata of db_file, None if absent"""
+    try:
+        camera_model = db_file.get_metadata('camera')['camera_model']
+        return int(camera_model['height']), int(camera_model['width'])
+    except (KeyError, TypeError, AttributeError):
+        return None
+
+
+def header_size(path):
+    """(height, width) of an image file, read from its header"""
+    with Image.open(path) as im:
+        width, height = im.size
+    return height, width
+
+
+def image_size(db_file):
+    """(xinit, yinit) = (height, width) of the image stored in db_file"""
+    path = _file_path(db_file)
+    key = (path, os.path.getmtime(path))
+    with _lock:
+        if key in _sizes:
+            return _sizes[key]
+    try:
+        size = header_size(path)
+    except OSError:
+        size = _metadata_size(db_file)
+        if size is None:
+            raise
+    with _lock:
+        _sizes[key] = size
+    return size
+
+
+def bucket_by_size(images_fileset):
+    """Groups the images by size: OrderedDict (xinit, yinit) -> list of (index, db_file),
+    in the order of images_fileset"""
+    buckets = OrderedDict()
+    for index, db_file in enumerate(images_fileset):
+        buckets.setdefault(image_size(db_file), []).append((index, db_file))
+    return buckets
+
+
+def fileset_image_size(images_fileset):
+    """Size shared by all the images of images_fileset, raises a ValueError if they differ"""
+    buckets = bucket_by_size(images_fileset)
+    if len(buckets) > 1:
+        sizes = ', '.join('%dx%d (%d images)'%(s[0], s[1], len(b)) for s, b in buckets.items())
+        raise ValueError('images of different sizes: %s' % sizes)
+    return next(iter(buckets))
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+In-process cache of the segmentation models.
+
+Loading a ResNet101 UNet from disk takes seconds, the registry keeps the
+models that were loaded by the current process so that consecutive scans
+processed by the same worker reuse a warm model. Entries are keyed by the
+weights file (path, modification time and size, so that a replaced file is
+reloaded), the device and an optional variant tag, and evicted in least
+recently used order when the memory cap is exceeded.
+
+The cap is read from the ROMISEG_MODEL_CACHE_MB environment variable
+(default 2048 MB) and can be changed with model_registry.max_bytes.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+
+def model_nbytes(model, path = None):
+    """Memory held by the parameters and buffers of a model (file size for non torch models).
+    Frozen TorchScript and quantized modules keep their weights as constants or packed
+    parameters: when the sum is 0 the size of the weights file path is used instead."""
+    try:
+        tensors = list(model.parameters()) + list(model.buffers())
+    except AttributeError:
+        nbytes = getattr(model, 'nbytes', 0)
+    else:
+        nbytes = sum(t.numel() * t.element_size() for t in tensors)
+    if nbytes == 0 and path is not None:
+        nbytes = os.path.getsize(path)
+    return nbytes
+
+
+class ModelRegistry(object):
+    """LRU registry of loaded models.
+    max_bytes: memory cap of the cached models (None: no cap)
+    max_models: maximum number of cached models (None: no limit)
+    The most recently used model is always kept, even if it exceeds the cap.
+    """
+
+    def __init__(self, max_bytes = None, max_models = None):
+        self.max_bytes = max_bytes
+        self.max_models = max_models
+        self._models = OrderedDict() #key -> (model, nbytes)
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(path, device = None, tag = None):
+        """Cache key of the model stored in the weights file path"""
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        return (path, st.st_mtime_ns, st.st_size, str(device), tag)
+
+    def get(self, path, load, device = None, tag = None):
+        """Returns the cached model of the weights file path, calls load() to build it on a miss"""
+        key = self.key(path, device, tag)
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                self.hits += 1
+                return self._models[key][0]
+            self.misses += 1
+            #an older version of the same file will never be requested again
+            self._drop(lambda k: k[0] == key[0] and k[1:3] != key[1:3])
+            model = load()
+            self._models[key] = (model, model_nbytes(model, path))
+            self._shrink()
+            return model
+
+    def evict(self, path = None, device = None):
+        """Removes the models loaded from path (all the models if path is None),
+        optionally only those placed on device. Returns the number of evicted models."""
+        with self._lock:
+            if path is None:
+                match = lambda k: device is None or k[3] == str(device)
+            else:
+                path = os.path.realpath(path)
+                match = lambda k: k[0] == path and (device is None or k[3] == str(device))
+            return self._drop(match)
+
+    def clear(self):
+        return self.evict()
+
+    @property
+    def nbytes(self):
+        with self._lock:
+            return sum(n for _, n in self._models.values())
+
+    def __len__(self):
+        return len(self._models)
+
+    def __contains__(self, path):
+        path = os.path.realpath(path)
+        return any(k[0] == path for k in self._models)
+
+    def _drop(self, match):
+        keys = [k for k in self._models if match(k)]
+        for k in keys:
+            del self._models[k]
+        return len(keys)
+
+    def _shrink(self):
+        while len(self._models) > 1:
+            too_many = self.max_models is not None and len(self._models) > self.max_models
+            too_big = self.max_bytes is not None and self.nbytes > self.max_bytes
+            if not (too_many or too_big):
+                break
+            self._models.popitem(last = False)
+
+
+model_registry = ModelRegistry(max_bytes = int(os.environ.get('ROMISEG_MODEL_CACHE_MB', 2048)) * 2**20)
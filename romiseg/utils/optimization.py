@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Inference-time graph optimization of the segmentation networks.
+
+optimize_for_inference(model) returns a frozen TorchScript module computing
+the same logits as model, faster:
+  -the BatchNorm layers of the backbone are folded in the weights of the
+   preceding convolutions (FX graph rewrite),
+  -the weights and activations are stored channels last (NHWC), the layout
+   of the oneDNN convolution kernels,
+  -the graph is traced and frozen (parameters become constants), and on CPU
+   torch.jit.optimize_for_inference fuses the Conv2d + ReLU of the convrelu
+   blocks and of the backbone into single oneDNN operations.
+The output of the optimized module is compared to the output of model on a
+random input: if they differ by more than the tolerance, a warning is issued
+and model is returned unchanged. The gain depends on the CPU (oneDNN kernels,
+AVX512): with min_speedup set, both versions are timed and model is also kept
+if the optimized module is not faster (inference_benchmark.py --optimize 0,1
+compares them once per node instead).
+"""
+
+import copy
+import warnings
+
+import torch
+
+from romiseg.utils.evaluation import time_forward
+
+
+class ChannelsLast(torch.nn.Module):
+    """Converts the input to channels last before model"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input):
+        return self.model(input.contiguous(memory_format = torch.channels_last))
+
+
+def fold_batch_norm(model):
+    """Copy of an eval mode model with the BatchNorm layers folded in the convolutions"""
+    from torch.fx.experimental.optimization import fuse
+    return fuse(copy.deepcopy(model).eval())
+
+
+def max_error(reference, candidate, inputs):
+    """Largest absolute difference between the outputs of two models, relative to the largest
+    reference output (at least 1)"""
+    with torch.no_grad():
+        ref = reference(inputs).float()
+        out = candidate(inputs).float()
+    return float((out - ref).abs().max() / ref.abs().max().clamp(min = 1))
+
+
+def optimize_for_inference(model, size = (64, 64), tolerance = 1e-3, timing_size = (256, 256), min_speedup = None):
+    """Optimized frozen TorchScript module of the eval mode model, see above. The graph is traced
+    on a [1, 3, size] input (the networks are fully convolutional, any size multiple of 32 can be
+    segmented afterwards). TorchScript and onnxruntime models are returned unchanged.
+    With min_speedup set, the forward passes on a [1, 3, timing_size] input are timed and model is
+    returned if the optimized module is not min_speedup times faster."""
+    if not isinstance(model, torch.nn.Module) or isinstance(model, torch.jit.ScriptModule):
+        return model
+    model = model.eval()
+    param = next(model.parameters())
+    example = torch.rand(1, 3, *size, device = param.device)
+    with torch.no_grad():
+        optimized = ChannelsLast(fold_batch_norm(model).to(memory_format = torch.channels_last)).eval()
+        optimized = torch.jit.freeze(torch.jit.trace(optimized, example))
+        if param.device.type == 'cpu':
+            optimized = torch.jit.optimize_for_inference(optimized)
+
+    error = max_error(model, optimized, torch.rand(2, 3, *size, device = param.device))
+    if error > tolerance:
+        warnings.warn('optimized model differs from the model by %g, not used'%error)
+        return model
+    if min_speedup is not None:
+        inputs = torch.rand(1, 3, *timing_size, device = param.device)
+        if time_forward(model, inputs) < min_speedup * time_forward(optimized, inputs):
+            return model
+    return optimized
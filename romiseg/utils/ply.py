@@ -26,6 +26,8 @@
 import numpy as np
 import sys
 
+from romiseg.utils.profiling import profiler
+
 
 # Define PLY types
 ply_dtypes = dict([
@@ -227,44 +229,45 @@ def write_ply(filename, field_list, field_names):
     if not filename.endswith('.ply'):
         filename += '.ply'
 
-    # open in text mode to write the header
-    with open(filename, 'w') as plyfile:
+    with profiler.stage('ply_write', n_points[0]):
+        # open in text mode to write the header
+        with open(filename, 'w') as plyfile:
 
-        # First magical word
-        header = ['ply']
+            # First magical word
+            header = ['ply']
 
-        # Encoding format
-        header.append('format binary_' + sys.byteorder + '_endian 1.0')
+            # Encoding format
+            header.append('format binary_' + sys.byteorder + '_endian 1.0')
 
-        # Points properties description
-        header.extend(header_properties(field_list, field_names))
+            # Points properties description
+            header.extend(header_properties(field_list, field_names))
 
-        # End of header
-        header.append('end_header')
+            # End of header
+            header.append('end_header')
 
-        # Write all lines
-        for line in header:
-            plyfile.write("%s\n" % line)
+            # Write all lines
+            for line in header:
+                plyfile.write("%s\n" % line)
 
 
-    # open in binary/append to use tofile
-    with open(filename, 'ab') as plyfile:
+        # open in binary/append to use tofile
+        with open(filename, 'ab') as plyfile:
 
-        # Create a structured array
-        i = 0
-        type_list = []
-        for fields in field_list:
-            for field in fields.T:
-                type_list += [(field_names[i], field.dtype.str)]
-                i += 1
-        data = np.empty(field_list[0].shape[0], dtype=type_list)
-        i = 0
-        for fields in field_list:
-            for field in fields.T:
-                data[field_names[i]] = field
-                i += 1
+            # Create a structured array
+            i = 0
+            type_list = []
+            for fields in field_list:
+                for field in fields.T:
+                    type_list += [(field_names[i], field.dtype.str)]
+                    i += 1
+            data = np.empty(field_list[0].shape[0], dtype=type_list)
+            i = 0
+            for fields in field_list:
+                for field in fields.T:
+                    data[field_names[i]] = field
+                    i += 1
 
-        data.tofile(plyfile)
+            data.tofile(plyfile)
 
     return True
 
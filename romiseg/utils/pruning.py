@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Structured channel pruning of the ResNetUNet decoder.
+
+The convrelu blocks of the decoder (1x1 convolutions of the encoder stages,
+conv_up3..conv_up0 and the full resolution conv_original_size0..2) are
+narrowed: the output channels of a block are ranked by their mean activation
+on calibration images times the norm of the weights reading them in the
+next convolution, the least important ones are removed from the block and
+from the input of its consumers. The result is a dense ResNetUNet with
+smaller widths (see segmentation_model.build_unet), saved and loaded like
+any other network by romiseg.utils.weights_store. The encoder is not pruned.
+
+A short fine-tuning on the soft masks of the original network recovers most
+of the accuracy lost by the pruning, without labels.
+"""
+
+import copy
+
+import torch
+import torch.nn.functional as F
+
+from romiseg.utils.segmentation_model import ResNetUNet
+
+
+#input of each convolution: concatenation of the outputs of these blocks, in order
+INPUTS = {'conv_up3': ['layer4_1x1', 'layer3_1x1'],
+          'conv_up2': ['conv_up3', 'layer2_1x1'],
+          'conv_up1': ['conv_up2', 'layer1_1x1'],
+          'conv_up0': ['conv_up1', 'layer0_1x1'],
+          'conv_original_size1': ['conv_original_size0'],
+          'conv_original_size2': ['conv_up0', 'conv_original_size1'],
+          'conv_last': ['conv_original_size2']}
+
+PRUNABLE = ['layer0_1x1', 'layer1_1x1', 'layer2_1x1', 'layer3_1x1', 'layer4_1x1',
+            'conv_up3', 'conv_up2', 'conv_up1', 'conv_up0',
+            'conv_original_size0', 'conv_original_size1', 'conv_original_size2']
+
+#the decoder blocks dominating the FLOPs at 896x896
+DEFAULT_LAYERS = ['conv_up3', 'conv_up2', 'conv_up1', 'conv_original_size0', 'conv_original_size1']
+
+
+def _conv(model, name):
+    """Convolution of a convrelu block (or conv_last)"""
+    module = getattr(model, name)
+    return module if isinstance(module, torch.nn.Conv2d) else module[0]
+
+
+def _consumer(name):
+    """Convolution reading the output of block name, and the offset of that output in its input"""
+    for consumer, parts in INPUTS.items():
+        if name in parts:
+            return consumer, parts[:parts.index(name)]
+    raise ValueError('%s is not a block of the decoder'%name)
+
+
+def count_flops(model, Sx = 896, Sy = 896):
+    """Multiply-adds of the convolutions of a forward pass of a [1, 3, Sx, Sy] image, x2"""
+    flops = [0]
+    def hook(module, inputs, output):
+        kh, kw = module.kernel_size
+        flops[0] += 2 * output.numel() * module.in_channels // module.groups * kh * kw
+    handles = [m.register_forward_hook(hook) for m in model.modules() if isinstance(m, torch.nn.Conv2d)]
+    try:
+        param = next(model.parameters())
+        with torch.no_grad():
+            model(torch.zeros(1, 3, Sx, Sy, device = param.device, dtype = param.dtype))
+    finally:
+        for h in handles:
+            h.remove()
+    return flops[0]
+
+
+def channel_importance(model, batches, layers = DEFAULT_LAYERS):
+    """Importance of the output channels of the blocks layers: mean activation over the
+    calibration batches times the L2 norm of the consumer weights reading the channel"""
+    activations = {name: 0 for name in layers}
+    def hook(name):
+        def record(module, inputs, output):
+            activations[name] = activations[name] + output.detach().abs().mean(dim = (0, 2, 3)).float()
+        return record
+    handles = [getattr(model, name).register_forward_hook(hook(name)) for name in layers]
+    try:
+        with torch.no_grad():
+            for inputs in batches:
+                model(inputs)
+    finally:
+        for h in handles:
+            h.remove()
+
+    importance = {}
+    for name in layers:
+        consumer, before = _consumer(name)
+        offset = sum(_conv(model, part).out_channels for part in before)
+        width = _conv(model, name).out_channels
+        weight = _conv(model, consumer).weight.detach()[:, offset:offset + width]
+        importance[name] = activations[name].cpu() * weight.float().pow(2).sum(dim = (0, 2, 3)).sqrt().cpu()
+    return importance
+
+
+def prune_channels(model, importance, ratio = 0.5, multiple = 8, min_channels = 16):
+    """Dense copy of model without the least important fraction ratio of the output channels of
+    the blocks of importance (see channel_importance). The number of kept channels is rounded
+    up to a multiple of multiple (vectorized kernels), at least min_channels."""
+    keep = {}
+    for name, scores in importance.items():
+        width = len(scores)
+        n = max(min_channels, int(round(width * (1 - ratio))))
+        n = min(width, -(-n // multiple) * multiple)
+        keep[name] = torch.sort(torch.topk(scores, n).indices).values
+
+    widths = dict(getattr(model, 'widths', {}), **{name: len(k) for name, k in keep.items()})
+    device = next(model.parameters()).device
+    pruned = ResNetUNet(model.conv_last.out_channels, pretrained = False,
+                        backbone = getattr(model, 'backbone', 'resnet101'), widths = widths)
+
+    state = model.state_dict()
+    for name in PRUNABLE + ['conv_last']:
+        prefix = name + '.' if name == 'conv_last' else name + '.0.'
+        weight = state[prefix + 'weight']
+        if name in keep:
+            weight = weight[keep[name]]
+            state[prefix + 'bias'] = state[prefix + 'bias'][keep[name]]
+        if name in INPUTS:
+            index = []
+            offset = 0
+            for part in INPUTS[name]:
+                width = _conv(model, part).out_channels
+                index.append(keep[part] + offset if part in keep else torch.arange(offset, offset + width))
+                offset += width
+            weight = weight[:, torch.cat(index)]
+        state[prefix + 'weight'] = weight.contiguous()
+    pruned.load_state_dict(state)
+    return pruned.to(device).eval()
+
+
+def distillation_error(model, batches, targets):
+    """Mean binary cross entropy of the logits of model against the soft masks targets"""
+    with torch.no_grad():
+        return sum(F.binary_cross_entropy_with_logits(model(inputs), target).item()
+                   for inputs, target in zip(batches, targets)) / len(batches)
+
+
+def fine_tune(model, reference, batches, steps = 100, lr = 1e-4):
+    """Trains the decoder of the pruned model for steps iterations on the soft masks of the
+    reference model (no labels needed). Batch norm statistics are not updated and the weights
+    are restored if the fine-tuning does not lower the error on the batches.
+    Returns the error before and after."""
+    model.eval()
+    params = [p for name, p in model.named_parameters()
+              if not name.startswith(('base_model.', 'layer0.', 'layer1.', 'layer2.', 'layer3.', 'layer4.'))]
+    optimizer = torch.optim.Adam(params, lr = lr)
+    with torch.no_grad():
+        targets = [torch.sigmoid(reference(inputs)) for inputs in batches]
+    initial = copy.deepcopy(model.state_dict())
+    before = distillation_error(model, batches, targets)
+    for step in range(steps):
+        i = step % len(batches)
+        optimizer.zero_grad()
+        loss = F.binary_cross_entropy_with_logits(model(batches[i]), targets[i])
+        loss.backward()
+        torch.nn.utils.clip_grad_norm_(params, 1.)
+        optimizer.step()
+    after = distillation_error(model, batches, targets)
+    if after > before:
+        model.load_state_dict(initial)
+    return before, after
+
+
+def prune_model(model, calibration_batches, ratio = 0.5, layers = DEFAULT_LAYERS, steps = 100, lr = 1e-4):
+    """Pruned and fine-tuned copy of model, see the functions above. The model is left unchanged."""
+    calibration_batches = list(calibration_batches)
+    reference = copy.deepcopy(model).eval()
+    importance = channel_importance(reference, calibration_batches, layers)
+    pruned = prune_channels(reference, importance, ratio)
+    if steps > 0:
+        fine_tune(pruned, reference, calibration_batches, steps, lr)
+    return pruned.eval()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Post-training static int8 quantization of the segmentation networks for CPU
+inference.
+
+The network is quantized in FX graph mode: the Conv2d/BatchNorm/ReLU of the
+ResNet backbone and the Conv2d/ReLU blocks built by convrelu are fused, the
+activation ranges are calibrated on a few scan images and the fused blocks
+are converted to int8 kernels. The quantized network takes and returns
+float tensors, like the original one.
+"""
+
+import copy
+
+import torch
+
+
+def quantization_engine(engine = None):
+    """Selects the quantized kernels ('x86', 'fbgemm' or 'qnnpack' for ARM nodes)"""
+    supported = torch.backends.quantized.supported_engines
+    if engine is None:
+        engine = 'x86' if 'x86' in supported else 'fbgemm'
+    if engine not in supported:
+        raise ValueError('quantization engine %s not supported, use one of %s'%(engine, supported))
+    torch.backends.quantized.engine = engine
+    return engine
+
+
+def quantize_model(model, calibration_batches, engine = None):
+    """Returns an int8 copy of model, calibrated on calibration_batches (iterable of [N, 3, Sx, Sy]
+    float tensors, a few scan images are enough). The model is left unchanged.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    engine = quantization_engine(engine)
+    calibration_batches = list(calibration_batches)
+    model = copy.deepcopy(model).cpu().eval()
+    prepared = prepare_fx(model, get_default_qconfig_mapping(engine), (calibration_batches[0],))
+    with torch.no_grad():
+        for inputs in calibration_batches:
+            prepared(inputs)
+    return convert_fx(prepared)
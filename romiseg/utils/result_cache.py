@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of the segmentation results.
+
+Re-running the pipeline after changing only the reconstruction parameters
+segments the same images with the same network again. The result cache
+stores the prediction of each view in a directory, compressed (.npz), under
+a key made of
+  -the sha256 of the image file content
+  -the sha256 of the weights file
+  -Sx, Sy, the label names and the options that change the predictions
+   (precision, tiling, storage dtype...)
+so that a hit is only possible for the exact same computation, and skips
+the image decoding and the forward pass. Files are evicted in least recently
+used order (file modification time, refreshed on hits) when the size of the
+directory exceeds max_bytes.
+
+The default size cap is read from the ROMISEG_RESULT_CACHE_MB environment
+variable (default 10240 MB).
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+import numpy as np
+import torch
+
+from romiseg.utils.hashing import file_digest
+
+
+#options of segmentation() that do not change the predictions
+THROUGHPUT_OPTIONS = ('batch_size', 'num_workers', 'prefetch_factor')
+
+
+class ResultCache(object):
+    """Size bounded LRU cache of predictions in directory.
+    max_bytes: cap of the total size of the cached files (None: no cap)
+    """
+
+    def __init__(self, directory, max_bytes = None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._nbytes = None #total size, computed on the first write
+
+    def context(self, weights_path, Sx, Sy, label_names, **options):
+        """Part of the key shared by all the images segmented by one call to segmentation()"""
+        options = {k: v for k, v in options.items() if k not in THROUGHPUT_OPTIONS}
+        return json.dumps([file_digest(weights_path), Sx, Sy, list(label_names), options],
+                          sort_keys = True, default = str)
+
+    def key(self, image_path, context):
+        """Key of the prediction of an image file"""
+        h = hashlib.sha256(context.encode())
+        h.update(file_digest(image_path).encode())
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.npz')
+
+    def contains(self, key):
+        """True if the prediction of key is cached, without loading it. Misses are counted here,
+        hits by the get loading the prediction."""
+        if os.path.isfile(self._path(key)):
+            return True
+        with self._lock:
+            self.misses += 1
+        return False
+
+    def get(self, key):
+        """Cached prediction tensor of key, None on a miss"""
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                pred = torch.from_numpy(data['pred'])
+            os.utime(path) #most recently used
+        except (OSError, KeyError, ValueError): #absent, evicted meanwhile or truncated
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return pred
+
+    def put(self, key, pred):
+        """Stores a prediction tensor"""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        #written next to its final place and renamed, readers never see a partial file
+        fd, tmp = tempfile.mkstemp(dir = os.path.dirname(path), suffix = '.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez_compressed(f, pred = pred.cpu().numpy())
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        with self._lock:
+            if self._nbytes is not None:
+                self._nbytes += os.path.getsize(path)
+        self._shrink()
+
+    def _files(self):
+        """(mtime, size, path) of the cached files"""
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith('.npz'):
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    files.append((st.st_mtime, st.st_size, path))
+        return files
+
+    @property
+    def nbytes(self):
+        with self._lock:
+            if self._nbytes is None:
+                self._nbytes = sum(size for _, size, _ in self._files())
+            return self._nbytes
+
+    def _shrink(self):
+        if self.max_bytes is None or self.nbytes <= self.max_bytes:
+            return
+        with self._lock:
+            files = sorted(self._files())
+            total = sum(size for _, size, _ in files)
+            for _, size, path in files[:-1]: #the most recent file is kept
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+            self._nbytes = total
+
+    def clear(self):
+        for _, _, path in self._files():
+            os.remove(path)
+        with self._lock:
+            self._nbytes = 0
+
+    def stats(self):
+        """Hit and miss counters"""
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0., 'bytes': self.nbytes}
+
+
+_caches = {}
+
+
+def get_result_cache(cache):
+    """ResultCache from a ResultCache or a directory (None: no cache). The caches of a
+    directory are shared by the whole process so that the counters add up."""
+    if cache is None or isinstance(cache, ResultCache):
+        return cache
+    directory = os.path.realpath(os.path.expanduser(cache))
+    if directory not in _caches:
+        max_bytes = int(os.environ.get('ROMISEG_RESULT_CACHE_MB', 10240)) * 2**20
+        _caches[directory] = ResultCache(directory, max_bytes)
+    return _caches[directory]
@@ -11,6 +11,7 @@ import torch.nn as nn
 from torchvision import models
 import torch.nn.functional as F
 import romiseg.utils.vox_to_coord as vtc
+from romiseg.utils.profiling import profiler
 
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
@@ -22,38 +23,91 @@ def convrelu(in_channels, out_channels, kernel, padding):
         nn.ReLU(inplace=True),
     )
 
-class ResNetUNet(nn.Module):
-
-    def __init__(self, n_class):
-        super().__init__()
-
-        # Use ResNet18 as the encoder with the pretrained weights
-        self.base_model = models.resnet101(pretrained=True)
-        self.base_layers = list(self.base_model.children())
 
-        self.layer0 = nn.Sequential(*self.base_layers[:3]) # size=(N, 64, x.H/2, x.W/2)
-        self.layer0_1x1 = convrelu(64, 64, 1, 0)
-        self.layer1 = nn.Sequential(*self.base_layers[3:5]) # size=(N, 256, x.H/4, x.W/4)
-        self.layer1_1x1 = convrelu(256, 256, 1, 0)
-        self.layer2 = self.base_layers[5]  # size=(N, 512, x.H/8, x.W/8)
-        self.layer2_1x1 = convrelu(512, 512, 1, 0)
-        self.layer3 = self.base_layers[6]  # size=(N, 1024, x.H/16, x.W/16)
-        self.layer3_1x1 = convrelu(1024, 512, 1, 0)
-        self.layer4 = self.base_layers[7]  # size=(N, 2048, x.H/32, x.W/32)
-        self.layer4_1x1 = convrelu(2048, 1024, 1, 0)
+#encoders, from the fastest to the most accurate
+BACKBONES = ('mobilenet_v2', 'resnet18', 'resnet34', 'resnet50', 'resnet101')
+
+
+def encoder(backbone = 'resnet101', pretrained = True):
+    """Torchvision classification network backbone split in 5 stages of output strides 2, 4, 8,
+    16 and 32. Returns the network and the list of its stages."""
+    if backbone not in BACKBONES:
+        raise ValueError('backbone should be one of %s, got %s'%(list(BACKBONES), backbone))
+    base_model = getattr(models, backbone)(pretrained=pretrained)
+    if backbone == 'mobilenet_v2':
+        features = list(base_model.features.children())
+        #the last 1x1 convolution to 1280 channels is left out
+        stages = [features[:2], features[2:4], features[4:7], features[7:14], features[14:18]]
+        return base_model, [nn.Sequential(*stage) for stage in stages]
+    base_layers = list(base_model.children())
+    return base_model, [nn.Sequential(*base_layers[:3]), nn.Sequential(*base_layers[3:5])] + base_layers[5:8]
+
+
+def stage_channels(stages):
+    """Number of channels output by each encoder stage, probed on a small input"""
+    channels = []
+    device = next(stages[0].parameters()).device
+    x = torch.zeros(1, 3, 64, 64, device = device)
+    training = [stage.training for stage in stages]
+    with torch.no_grad():
+        for stage in stages:
+            x = stage.eval()(x) #batch norm statistics unchanged
+            channels.append(x.shape[1])
+    for stage, mode in zip(stages, training):
+        stage.train(mode)
+    return channels
+
+
+def build_unet(net, n_class, backbone = 'resnet101', pretrained = True, widths = None):
+    """Creates the layers of the UNet net on the encoder backbone. The width of the 1x1
+    convolutions applied to the encoder stages is the width of the stage (halved above 512
+    channels), each decoder stage outputs the width of its skip connection (at least 128).
+    With resnet101 these are the layers of the original network.
+    widths: output channels of some of the convrelu blocks (e.g. {'conv_up3': 256}), by name,
+    overriding the default ones (networks pruned by romiseg.utils.pruning)."""
+    net.backbone = backbone
+    net.widths = dict(widths or {})
+    net.base_model, stages = encoder(backbone, pretrained)
+    if backbone == 'mobilenet_v2':
+        net.base_layers = list(net.base_model.features.children())
+    else:
+        net.base_layers = list(net.base_model.children())
+    channels = stage_channels(stages)
+    lateral = [c if c <= 512 else c // 2 for c in channels]
+    up = [max(c, 128) for c in lateral[:4]]
+    w = dict({'layer%d_1x1'%i: lateral[i] for i in range(5)}, conv_original_size0 = 64,
+             conv_original_size1 = 64, conv_original_size2 = 64,
+             **{'conv_up%d'%i: up[i] for i in range(4)})
+    w.update(net.widths)
+
+    net.layer0, net.layer1, net.layer2, net.layer3, net.layer4 = stages
+    net.layer0_1x1 = convrelu(channels[0], w['layer0_1x1'], 1, 0)
+    net.layer1_1x1 = convrelu(channels[1], w['layer1_1x1'], 1, 0)
+    net.layer2_1x1 = convrelu(channels[2], w['layer2_1x1'], 1, 0)
+    net.layer3_1x1 = convrelu(channels[3], w['layer3_1x1'], 1, 0)
+    net.layer4_1x1 = convrelu(channels[4], w['layer4_1x1'], 1, 0)
+
+    net.upsample = nn.Upsample(scale_factor=2, mode='bilinear', align_corners=True)
+
+    net.conv_up3 = convrelu(w['layer4_1x1'] + w['layer3_1x1'], w['conv_up3'], 3, 1)
+    net.conv_up2 = convrelu(w['conv_up3'] + w['layer2_1x1'], w['conv_up2'], 3, 1)
+    net.conv_up1 = convrelu(w['conv_up2'] + w['layer1_1x1'], w['conv_up1'], 3, 1)
+    net.conv_up0 = convrelu(w['conv_up1'] + w['layer0_1x1'], w['conv_up0'], 3, 1)
+
+    net.conv_original_size0 = convrelu(3, w['conv_original_size0'], 3, 1)
+    net.conv_original_size1 = convrelu(w['conv_original_size0'], w['conv_original_size1'], 3, 1)
+    net.conv_original_size2 = convrelu(w['conv_up0'] + w['conv_original_size1'], w['conv_original_size2'], 3, 1)
+
+    net.conv_last = nn.Conv2d(w['conv_original_size2'], n_class, 1)
 
-        self.upsample = nn.Upsample(scale_factor=2, mode='bilinear', align_corners=True)
-
-        self.conv_up3 = convrelu(512 + 1024, 512, 3, 1)
-        self.conv_up2 = convrelu(512 + 512, 512, 3, 1)
-        self.conv_up1 = convrelu(256 + 512, 256, 3, 1)
-        self.conv_up0 = convrelu(64 + 256, 128, 3, 1)
+class ResNetUNet(nn.Module):
 
-        self.conv_original_size0 = convrelu(3, 64, 3, 1)
-        self.conv_original_size1 = convrelu(64, 64, 3, 1)
-        self.conv_original_size2 = convrelu(64 + 128, 64, 3, 1)
+    def __init__(self, n_class, pretrained = True, backbone = 'resnet101', widths = None):
+        super().__init__()
 
-        self.conv_last = nn.Conv2d(64, n_class, 1)
+        # Encoder with the pretrained weights, one of BACKBONES
+        # (pretrained = False: random initialization, no download, e.g. for benchmarks)
+        build_unet(self, n_class, backbone, pretrained, widths)
 
     def forward(self, input):
         x_original = self.conv_original_size0(input)
@@ -123,56 +177,33 @@ class ResNetUNet(nn.Module):
         return out
     
     
-def voxel_to_pred_by_project(the_shape, torch_voxels, intrinsics, extrinsics, preds_flat, pred_pad, Sx, Sy, xinit, yinit):
-        xy_coords = vtc.project_coordinates(torch_voxels, intrinsics, extrinsics, give_prod = False)
-        #permute x and y coordinates
-        xy_coords[:, 2, :] = xy_coords[:,0,:]
-        xy_coords[:, 0, :] = xy_coords[:,1,:]
-        xy_coords[:, 1, :] = xy_coords[:,2,:]
-        
-        coords = vtc.correct_coords_outside(xy_coords, Sx, Sy, xinit, yinit, -1) #correct the coordinates that project outside
-        xy_full_flat = vtc.flatten_coordinates(coords, the_shape)
-        assign_preds = preds_flat[xy_full_flat].reshape(pred_pad.shape[0], 
-                                                xy_full_flat.shape[0]//pred_pad.shape[0], preds_flat.shape[-1])
-        del xy_full_flat
-        
-        assign_preds = torch.sum(assign_preds, dim = 0)
-        assign_preds[:,0] *= 0.8
-        torch_voxels[:,3] = torch.argmax(assign_preds, dim = 1)
+def voxel_to_pred_by_project(the_shape, torch_voxels, intrinsics, extrinsics, preds_flat, pred_pad, Sx, Sy, xinit, yinit,
+                             chunk_size = None):
+        n_vox = torch_voxels.shape[0]
+        #the voxels are labelled by chunks of chunk_size voxels (default vtc.CHUNK_SIZE): the gathered
+        #predictions hold N_cam * chunk_size rows instead of N_cam * N_vox
+        for chunk in vtc.voxel_chunks(n_vox, chunk_size):
+            n = chunk.stop - chunk.start
+            xy_full_flat = vtc.project_flat_coordinates(torch_voxels[chunk], intrinsics, extrinsics, the_shape,
+                                                        Sx, Sy, xinit, yinit, chunk_size = n)
+            with profiler.stage('gather', n):
+                assign_preds = preds_flat[xy_full_flat].reshape(pred_pad.shape[0], n, preds_flat.shape[-1])
+                del xy_full_flat
+                
+                #sum in float32 whatever the storage dtype of the predictions (uint8, float16 or float32)
+                assign_preds = torch.sum(assign_preds, dim = 0, dtype = torch.float32)
+            with profiler.stage('argmax', n):
+                assign_preds[:,0] *= 0.8
+                torch_voxels[chunk, 3] = torch.argmax(assign_preds, dim = 1)
         return torch_voxels
 
 class ResNetUNet_3D(nn.Module):
 
-    def __init__(self, n_class, coord_file_loc):
+    def __init__(self, n_class, coord_file_loc, backbone = 'resnet101'):
         super().__init__()
 
-        # Use ResNet18 as the encoder with the pretrained weights
-        self.base_model = models.resnet101(pretrained=True)
-        self.base_layers = list(self.base_model.children())
-
-        self.layer0 = nn.Sequential(*self.base_layers[:3]) # size=(N, 64, x.H/2, x.W/2)
-        self.layer0_1x1 = convrelu(64, 64, 1, 0)
-        self.layer1 = nn.Sequential(*self.base_layers[3:5]) # size=(N, 256, x.H/4, x.W/4)
-        self.layer1_1x1 = convrelu(256, 256, 1, 0)
-        self.layer2 = self.base_layers[5]  # size=(N, 512, x.H/8, x.W/8)
-        self.layer2_1x1 = convrelu(512, 512, 1, 0)
-        self.layer3 = self.base_layers[6]  # size=(N, 1024, x.H/16, x.W/16)
-        self.layer3_1x1 = convrelu(1024, 512, 1, 0)
-        self.layer4 = self.base_layers[7]  # size=(N, 2048, x.H/32, x.W/32)
-        self.layer4_1x1 = convrelu(2048, 1024, 1, 0)
-
-        self.upsample = nn.Upsample(scale_factor=2, mode='bilinear', align_corners=True)
-
-        self.conv_up3 = convrelu(512 + 1024, 512, 3, 1)
-        self.conv_up2 = convrelu(512 + 512, 512, 3, 1)
-        self.conv_up1 = convrelu(256 + 512, 256, 3, 1)
-        self.conv_up0 = convrelu(64 + 256, 128, 3, 1)
-
-        self.conv_original_size0 = convrelu(3, 64, 3, 1)
-        self.conv_original_size1 = convrelu(64, 64, 3, 1)
-        self.conv_original_size2 = convrelu(64 + 128, 64, 3, 1)
-
-        self.conv_last = nn.Conv2d(64, n_class, 1)
+        # Encoder with the pretrained weights, one of BACKBONES
+        build_unet(self, n_class, backbone)
         
         lin = torch.nn.Linear(n_class+1, n_class)
         lin.weight.data.fill_(0)
@@ -272,20 +303,22 @@ class ResNetUNet_3D(nn.Module):
 
         #pred_pad = pred_pad.permute(0,2,3,1)
         #print(preds.shape)
-        pred_pad = F.sigmoid(torch.flip(x, dims = [0])).permute(0, 2, 3, 1)
-        pred_pad = vtc.adjust_predictions(pred_pad)
-        #print(preds.shape)
-        pred_pad = pred_pad[xy_full_flat].reshape(N_frames, 
-                               xy_full_flat.shape[0]//N_frames, pred_pad.shape[-1])
-        #print(preds.shape)
-        #preds[:,:,6] = 0
-        #print(preds.shape)
-        
-        pred_pad = self.class_layer(pred_pad)
-        #pred_pad = pred_pad.clamp(min=1e-8)
-        #pred_pad = torch.log(pred_pad)
-        #pred_pad  = torch.sum(pred_pad, dim = 0)
-        pred_pad = torch.prod(pred_pad, dim = 0)
+        #the product over the views underflows in reduced precision, keep it in float32
+        with torch.autocast(x.device.type, enabled = False):
+            pred_pad = F.sigmoid(torch.flip(x, dims = [0]).float()).permute(0, 2, 3, 1)
+            pred_pad = vtc.adjust_predictions(pred_pad)
+            #print(preds.shape)
+            pred_pad = pred_pad[xy_full_flat].reshape(N_frames, 
+                                   xy_full_flat.shape[0]//N_frames, pred_pad.shape[-1])
+            #print(preds.shape)
+            #preds[:,:,6] = 0
+            #print(preds.shape)
+            
+            pred_pad = self.class_layer(pred_pad)
+            #pred_pad = pred_pad.clamp(min=1e-8)
+            #pred_pad = torch.log(pred_pad)
+            #pred_pad  = torch.sum(pred_pad, dim = 0)
+            pred_pad = torch.prod(pred_pad, dim = 0)
         
         #print(preds.shape)
         #print(torch.max(preds, dim = 0))
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Long-lived segmentation service.
+
+The server listens on a Unix socket and keeps the segmentation networks warm
+in the model registry, so that the latency of a scan is only the compute.
+Clients send one job per connection, a JSON object on one line:
+
+    {"db": "/path/to/db", "scan": "scan_id", "fileset": "images",
+     "output_fileset": "Segmentation2D", "model": "model_name.pt",
+     "Sx": 896, "Sy": 896, "labels": "background,flower,peduncle,stem,leaf,fruit",
+     "options": {"batch_size": 4}}
+
+and receive one JSON line when the job is done: {"status": "ok", ...} or
+{"status": "error", "error": message}. "options" are the keyword options of
+segmentation(). Pending jobs sharing the same model and options are merged
+into one stream of images, so that batches are filled across scans (scans
+with images of different sizes are segmented by groups of same size).
+
+For each view and label, the predictions are written back to the output
+fileset of the scan as uint8 images ('<image id>_<label>') with the
+image_id and channel metadata. A job whose db, scan or fileset cannot be
+opened gets an error, the jobs merged with it are still segmented.
+
+The server connects to the FSDB of each job itself, and romidata locks a DB
+while it is connected: the client must not hold a connection to the DB while
+its job runs (disconnect before submit(), reconnect afterwards).
+"""
+
+import collections
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+import traceback
+
+
+class Job(object):
+    """Segmentation request of a scan, waiting for its result"""
+
+    required = ('db', 'scan', 'model', 'labels')
+
+    def __init__(self, request):
+        missing = [k for k in self.required if k not in request]
+        if missing:
+            raise ValueError('missing job fields: %s' % ', '.join(missing))
+        self.request = request
+        self.done = threading.Event()
+        self.result = None
+
+    def batch_key(self):
+        """Jobs with the same key can go through the network together"""
+        r = self.request
+        return json.dumps([r['model'], r.get('Sx', 896), r.get('Sy', 896), r['labels'],
+                           r.get('options', {})], sort_keys = True)
+
+    def finish(self, result):
+        self.result = result
+        self.done.set()
+
+
+class SegmentationServer(object):
+    """Segmentation service of the models stored in directory_weights.
+    max_merge: maximum number of pending jobs merged in one segmentation stream
+    options: default keyword options of segmentation(), overridden by the jobs
+    """
+
+    def __init__(self, socket_path, directory_weights, max_merge = 8, **options):
+        self.socket_path = socket_path
+        self.directory_weights = directory_weights
+        self.max_merge = max_merge
+        self.options = options
+        self.jobs = queue.Queue()
+        self._server = None
+
+    def submit(self, request):
+        """Queues a job and waits for its result"""
+        job = Job(request)
+        self.jobs.put(job)
+        job.done.wait()
+        return job.result
+
+    def serve_forever(self):
+        if os.path.exists(self.socket_path):
+            #a socket file left by a server that did not exit cleanly is removed, a live one is kept
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+                try:
+                    s.connect(self.socket_path)
+                except OSError:
+                    os.remove(self.socket_path)
+                else:
+                    raise RuntimeError('a server is already listening on %s' % self.socket_path)
+        worker = threading.Thread(target = self._work, daemon = True)
+        worker.start()
+        service = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                line = self.rfile.readline()
+                if not line:
+                    return #connection closed without a job, e.g. the liveness check of another server
+                try:
+                    request = json.loads(line.decode())
+                    result = service.submit(request)
+                except Exception as e:
+                    result = {'status': 'error', 'error': str(e)}
+                self.wfile.write((json.dumps(result) + '\n').encode())
+
+        self._server = socketserver.ThreadingUnixStreamServer(self.socket_path, Handler)
+        self._server.daemon_threads = True
+        print('segmentation server listening on %s' % self.socket_path)
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            os.remove(self.socket_path)
+
+    def shutdown(self):
+        if self._server is not None:
+            self._server.shutdown()
+
+    def _work(self):
+        pending = collections.deque() #jobs taken from the queue, in arrival order
+        while True:
+            if not pending:
+                pending.append(self.jobs.get())
+            while True:
+                try:
+                    pending.append(self.jobs.get_nowait())
+                except queue.Empty:
+                    break
+            #the oldest job goes first, merged with the pending jobs that share its network configuration
+            key = pending[0].batch_key()
+            jobs = []
+            others = collections.deque()
+            for job in pending:
+                if len(jobs) < self.max_merge and job.batch_key() == key:
+                    jobs.append(job)
+                else:
+                    others.append(job)
+            pending = others
+            try:
+                self._run(jobs)
+            except Exception as e:
+                traceback.print_exc()
+                for job in jobs:
+                    if not job.done.is_set():
+                        job.finish({'status': 'error', 'error': str(e)})
+
+    def _run(self, jobs):
+        from romiseg.Segmentation2D import segmentation_stream
+
+        t0 = time.time()
+        dbs = {}
+        try:
+            images = [] #images of all the jobs, in order
+            owners = [] #job and output fileset of each image
+            valid = []
+            for job in jobs:
+                #a job with a bad db, scan or fileset fails alone, the others are segmented
+                try:
+                    files, output = open_scan(dbs, job.request)
+                except Exception as e:
+                    job.finish({'status': 'error', 'error': str(e)})
+                    continue
+                valid.append(job)
+                images += files
+                owners += [(job, output)] * len(files)
+            if not valid:
+                return
+
+            r = valid[0].request
+            label_names = r['labels'].split(',')
+            options = dict(self.options)
+            options.update(r.get('options', {}))
+            options['pred_dtype'] = 'uint8'
+            stream = segmentation_stream(r.get('Sx', 896), r.get('Sy', 896), label_names, images, None,
+                                         r['model'], self.directory_weights, return_index = True, **options)
+            counts = {id(job): 0 for job in valid}
+            for index, id_im, pred in stream:
+                job, output = owners[index]
+                write_prediction(output, id_im, pred, label_names)
+                counts[id(job)] += 1
+        finally:
+            for db in dbs.values():
+                db.disconnect()
+
+        for job in valid:
+            job.finish({'status': 'ok', 'scan': job.request['scan'], 'images': counts[id(job)],
+                        'merged_jobs': len(valid), 'seconds': time.time() - t0})
+
+
+def open_scan(dbs, request):
+    """RGB images and output fileset of the scan of a job request. dbs: FSDB connected by path,
+    the FSDB of the request is connected and added if needed. Raises ValueError if the scan or
+    the fileset does not exist."""
+    from romidata import fsdb
+
+    if request['db'] not in dbs:
+        db = fsdb.FSDB(request['db'])
+        db.connect()
+        dbs[request['db']] = db
+    scan = dbs[request['db']].get_scan(request['scan'])
+    if scan is None:
+        raise ValueError('scan %s not found in %s' % (request['scan'], request['db']))
+    fileset_name = request.get('fileset', 'images')
+    fileset = scan.get_fileset(fileset_name)
+    if fileset is None:
+        raise ValueError('fileset %s not found in scan %s' % (fileset_name, request['scan']))
+    files = [f for f in fileset.get_files() if f.get_metadata('channel') in (None, 'rgb')]
+    output = scan.get_fileset(request.get('output_fileset', 'Segmentation2D'), create = True)
+    return files, output
+
+
+def write_prediction(output_fileset, id_im, pred, label_names):
+    """Writes the uint8 [N_labels, xinit, yinit] prediction of image id_im, one image per label"""
+    from romidata import io
+
+    for j, label in enumerate(label_names):
+        #a scan segmented again overwrites its previous predictions
+        f = output_fileset.get_file('%s_%s' % (id_im, label), create = True)
+        io.write_image(f, pred[j].numpy())
+        f.set_metadata('image_id', id_im)
+        f.set_metadata('channel', label)
+
+
+def submit(socket_path, request, timeout = None):
+    """Client side: sends a job to the server listening on socket_path and returns its result.
+    The DB of the job must not be connected by the caller meanwhile (romidata lock)."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(timeout)
+        s.connect(socket_path)
+        s.sendall((json.dumps(request) + '\n').encode())
+        with s.makefile('rb') as f:
+            return json.loads(f.readline().decode())
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Sliding-window (tiled) inference over full images.
+
+Images are cut in overlapping tiles of the size the network was trained on,
+tiles of consecutive images are batched together and the predictions are
+blended back into one buffer per image, so that the peak memory only depends
+on the tile batch and not on the image size.
+"""
+
+import math
+
+import torch
+import torch.nn.functional as F
+
+from romiseg.utils.precision import quantize_predictions
+
+
+def tile_origins(size, tile, overlap):
+    """Start positions of the tiles of length tile covering [0, size).
+    Consecutive tiles share at least overlap * tile pixels, the last tile is
+    aligned with the end of the image.
+    """
+    if tile >= size:
+        return [0]
+    stride = max(1, int(tile * (1 - overlap)))
+    n_tiles = math.ceil((size - tile) / stride) + 1
+    return [min(i * stride, size - tile) for i in range(n_tiles)]
+
+
+def blending_weights(tx, ty, blending = 'gaussian'):
+    """Weight map of size [tx, ty] used to blend overlapping tiles.
+    'uniform': plain average of the overlapping predictions
+    'linear': weights decrease linearly towards the tile borders
+    'gaussian': gaussian centered on the tile, sigma = tile size / 8
+    Weights are strictly positive so that every pixel is covered.
+    """
+    if blending == 'uniform':
+        return torch.ones(tx, ty)
+    if blending == 'linear':
+        wx = 1 - torch.abs(torch.linspace(-1, 1, tx))
+        wy = 1 - torch.abs(torch.linspace(-1, 1, ty))
+    elif blending == 'gaussian':
+        wx = torch.exp(-0.5 * (torch.linspace(-4, 4, tx)) ** 2)
+        wy = torch.exp(-0.5 * (torch.linspace(-4, 4, ty)) ** 2)
+    else:
+        raise ValueError('unknown blending mode: %s' % blending)
+    w = torch.outer(wx, wy)
+    return (w / w.max()).clamp(min = 1e-3)
+
+
+def tile_grid(xinit, yinit, tile_size, overlap):
+    """List of the (x0, y0) tile corners covering an image of size [xinit, yinit]"""
+    tx, ty = tile_size
+    return [(x0, y0) for x0 in tile_origins(xinit, tx, overlap)
+                     for y0 in tile_origins(yinit, ty, overlap)]
+
+
+def weight_sum(xinit, yinit, tile_size, overlap, weights):
+    """Sum of the blending weights over the image, used to normalize the blended predictions"""
+    tx, ty = weights.shape
+    norm = torch.zeros(xinit, yinit)
+    for x0, y0 in tile_grid(xinit, yinit, tile_size, overlap):
+        norm[x0:x0 + tx, y0:y0 + ty] += weights[:xinit - x0, :yinit - y0]
+    return norm
+
+
+def tiled_predict(loader, predict, image_size, tile_size, acquire, overlap = 0.25,
+                  blending = 'gaussian', batch_size = 1, keep = None):
+    """Segments full images tile by tile.
+    Inputs: -loader: iterable of (images [N, 3, xinit, yinit], image ids) batches
+            -predict: function mapping a batch of tiles [B, 3, tx, ty] to
+            predictions [B, N_labels, tx, ty]
+            -image_size: (xinit, yinit), shared by all the images
+            -tile_size: (tx, ty), input size of the network
+            -acquire: function returning for the index of an image the
+            [N_labels, xinit, yinit] buffer, initialized to 0, where its
+            prediction is assembled. float32 buffers are blended in place,
+            other dtypes get the quantized prediction once it is complete
+            -overlap: fraction of a tile shared with its neighbours
+            -blending: weighting of the overlapping tiles (see blending_weights)
+            -batch_size: number of tiles per forward pass, tiles of
+            consecutive images are batched together
+            -keep: optional function of an image [3, xinit, yinit] (padded
+            to the tile size) returning a function of its tiles [3, tx, ty],
+            False for the tiles that do not need the network: their
+            prediction is the first label (background) with probability 1
+    Yields (index, image id) in the order of the images, as soon as the prediction of an image is complete.
+    """
+    xinit, yinit = image_size
+    tx, ty = tile_size
+    #images smaller than a tile are padded, the padding is cropped from the predictions
+    px, py = max(tx - xinit, 0), max(ty - yinit, 0)
+    grid = tile_grid(xinit + px, yinit + py, tile_size, overlap)
+    weights = blending_weights(tx, ty, blending)
+    norm = weight_sum(xinit, yinit, tile_size, overlap, weights)
+
+    pending = [] #tiles waiting for a forward pass: (index, x0, y0, tile)
+    remaining = {} #number of tiles not yet predicted per image
+    ids = {}
+    scratch = {} #float32 blending buffers of the low precision outputs
+    done = set() #complete images not yet yielded
+    next_index = [0]
+
+    def blend_buffer(index):
+        out = acquire(index)
+        if out.dtype == torch.float32:
+            return out
+        if index not in scratch:
+            scratch[index] = torch.zeros(out.shape)
+        return scratch[index]
+
+    def blend(index, x0, y0, pred = None):
+        """Adds the prediction of a tile (background if pred is None) to its image"""
+        out = blend_buffer(index)
+        wx, wy = min(tx, xinit - x0), min(ty, yinit - y0)
+        if pred is None:
+            out[0, x0:x0 + wx, y0:y0 + wy] += weights[:wx, :wy]
+        else:
+            out[:, x0:x0 + wx, y0:y0 + wy] += pred[:, :wx, :wy] * weights[:wx, :wy]
+        remaining[index] -= 1
+        if remaining[index] == 0:
+            out /= norm
+            if index in scratch:
+                final = acquire(index)
+                final.copy_(quantize_predictions(scratch.pop(index), final.dtype))
+            done.add(index)
+
+    def flush():
+        tiles = torch.stack([t[3] for t in pending])
+        preds = predict(tiles).float().cpu()
+        for (index, x0, y0, _), pred in zip(pending, preds):
+            blend(index, x0, y0, pred)
+        pending.clear()
+
+    def completed():
+        while next_index[0] in done:
+            i = next_index[0]
+            done.remove(i)
+            next_index[0] += 1
+            yield i, ids.pop(i)
+
+    index = 0
+    for images, id_ims in loader:
+        if px or py:
+            images = F.pad(images, (0, py, 0, px))
+        for image, id_im in zip(images, id_ims):
+            remaining[index] = len(grid)
+            ids[index] = id_im
+            keep_tile = None if keep is None else keep(image)
+            for x0, y0 in grid:
+                tile = image[:, x0:x0 + tx, y0:y0 + ty]
+                if keep_tile is not None and not keep_tile(tile):
+                    blend(index, x0, y0)
+                    continue
+                pending.append((index, x0, y0, tile))
+                if len(pending) == batch_size:
+                    flush()
+                    yield from completed()
+            yield from completed()
+            index += 1
+    if pending:
+        flush()
+    yield from completed()
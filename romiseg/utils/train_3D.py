@@ -17,9 +17,11 @@ from collections import defaultdict
 
 from tqdm import tqdm
 
+from romiseg.utils.image_decode import to_float_batch
 from romiseg.utils.dataloader_finetune import Dataset_im_label, plot_dataset, init_set
 import romiseg.utils.alienlab as alien
 from romiseg.utils.ply import write_ply
+from romiseg.utils.precision import autocast
 
 from torch.utils.tensorboard import SummaryWriter
 
@@ -79,7 +81,8 @@ def save_and_load_model(weights_folder, model_segmentation_name):
 
 
 def dice_loss(pred, target, smooth = 1.):
-    pred = pred.contiguous()
+    #sums over whole images, always computed in float32
+    pred = pred.float().contiguous()
     target = target.contiguous()    
 
     intersection = (pred * target).sum(dim=2).sum(dim=2)
@@ -98,6 +101,8 @@ def my_metric(outputs: torch.Tensor, labels: torch.Tensor):
 
 
 def calc_loss(pred, target, metrics, bce_weight=0.5):
+    pred = pred.float() #outputs of reduced precision forward passes
+    target = target.float()
     bce = F.binary_cross_entropy_with_logits(pred, target)
 
     pred = F.sigmoid(pred)
@@ -132,7 +137,10 @@ class classification(torch.nn.Module):
 
 
 def train_model_voxels(train_type, dataloaders, model, optimizer, scheduler, writer, 
-                       voxel_loss, torch_voxels, num_epochs=25, viz = False, label_names = []):
+                       voxel_loss, torch_voxels, num_epochs=25, viz = False, label_names = [],
+                       precision = 'float32'):
+    """precision: 'float32', or 'bfloat16' to run the forward passes under autocast
+    (the losses are computed in float32)"""
     L = []
     #best_model_wts = copy.deepcopy(model.state_dict())
     best_loss = 1e10
@@ -158,7 +166,7 @@ def train_model_voxels(train_type, dataloaders, model, optimizer, scheduler, wri
 
 
             for inputs, labels, voxels in dataloaders[phase]:
-                inputs = inputs.to(device)
+                inputs = to_float_batch(inputs, device)
                 labels = labels.to(device)
                 voxels = voxels.to(device).long()
 
@@ -168,7 +176,9 @@ def train_model_voxels(train_type, dataloaders, model, optimizer, scheduler, wri
                 # forward
                 # track history if only in train
                 with torch.set_grad_enabled(phase == 'train'):
-                    outputs = model(inputs)
+                    with autocast(precision, device):
+                        outputs = model(inputs)
+                    outputs = [o.float() for o in outputs]
                     pred_class = outputs[1]
                     if train_type == 'Segmentation':
                         loss = calc_loss(outputs[0], labels, metrics)
@@ -197,13 +207,15 @@ def train_model_voxels(train_type, dataloaders, model, optimizer, scheduler, wri
         
             if phase == 'val':
                 inputs, labels, voxels = next(iter(dataloaders[phase]))
-                inputs = inputs.to(device)
+                inputs = to_float_batch(inputs, device)
                 labels = labels.to(device)
                 voxels = voxels.to(device)
                 lab = torch.argmax(labels, dim = 1)
                 # forward
                 # track history if only in train
-                outputs = model(inputs)
+                with torch.no_grad(), autocast(precision, device):
+                    outputs = model(inputs)
+                outputs = [o.float() for o in outputs]
 
                 out = torch.argmax(outputs[0], dim = 1)
                 loss_test.append(my_metric(out, lab))
@@ -314,8 +326,8 @@ def fine_tune_train(path_train, path_val, weights_folder, label_names, tsboard_n
     image_train, target_train = init_set('', path_train, 'jpg')
     image_val, target_val = init_set('', path_val, 'jpg')
 
-    train_dataset = Dataset_im_label(image_train, target_train, transform = trans)
-    val_dataset = Dataset_im_label(image_val, target_val, transform = trans) 
+    train_dataset = Dataset_im_label(image_train, target_train, transform = trans, crop = (Sx, Sy))
+    val_dataset = Dataset_im_label(image_val, target_val, transform = trans, crop = (Sx, Sy)) 
     
         
     batch_size = min(num_classes, len(image_train))
@@ -365,16 +377,17 @@ def fine_tune_train(path_train, path_val, weights_folder, label_names, tsboard_n
 
     
 # Prediction
-def evaluate(inputs, model):
+def evaluate(inputs, model, precision = 'float32'):
 
     with torch.no_grad():
         inputs.requires_grad = False
         # Get the first batch
-        inputs = inputs.to(device)
+        inputs = to_float_batch(inputs, device)
 
-        pred = model(inputs)
+        with autocast(precision, inputs.device):
+            pred = model(inputs)
         # The loss functions include the sigmoid function.
-        pred = F.sigmoid(pred)
+        pred = F.sigmoid(pred.float())
         
     return pred
     
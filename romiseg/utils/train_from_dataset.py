@@ -13,63 +13,80 @@ import torchvision
 import torch.optim as optim
 import torch.nn.functional as F
 from collections import defaultdict
-import matplotlib.pyplot as plt
 
 from tqdm import tqdm
 
-from romiseg.utils.dataloader_finetune import Dataset_im_label, plot_dataset, init_set
-import romiseg.utils.alienlab as alien
-
-from torch.utils.tensorboard import SummaryWriter
+from romiseg.utils.image_decode import to_float_batch
+from romiseg.utils.model_registry import model_registry
+from romiseg.utils.export import is_torchscript, load_torchscript, is_onnx
+from romiseg.utils.backends import OnnxRuntimeModel, to_backend
+from romiseg.utils import weights_store
+from romiseg.utils.optimization import optimize_for_inference
+from romiseg.utils.precision import autocast
 
 from torch.utils.data import DataLoader
 
 from torchvision import transforms
 
-import matplotlib.pyplot as plt
 import os
-import requests
 import copy
+import inspect
 
 
 import warnings
 warnings.filterwarnings("ignore")
 
+#matplotlib, tensorboard, requests and the finetuning dataset are imported
+#by the functions using them: importing this module for inference stays cheap
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-print(device)
 
 ##################LOAD PRE-TRAINED WEIGHTS############
 
 def download_file(url, target_dir):
-    local_filename = url.split('/')[-1]
-    # NOTE the stream=True parameter below
-    with requests.get(url, stream=True) as r:
-        r.raise_for_status()
-        with open(target_dir + '/' +local_filename, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=8192): 
-                if chunk: # filter out keep-alive new chunks
-                    f.write(chunk)
-                    # f.flush()
-    return local_filename
-
-def save_and_load_model(weights_folder, model_segmentation_name):
-
-
-    #if not already saved, download from database 
-    if model_segmentation_name not in os.listdir(weights_folder):
-        
-        url = 'http://db.romi-project.eu/models/' + model_segmentation_name 
-        
-        download_file(url, weights_folder)
-        
-    model_segmentation = torch.load(weights_folder + '/' + model_segmentation_name)[0]
+    """Downloads url in target_dir (atomically), returns the file name"""
+    return os.path.basename(weights_store.download(url, target_dir))
+
+def load_model(model_path, device = device):
+    """Loads the segmentation model stored in model_path on device, in eval mode.
+    model_path is either a state_dict saved by romiseg.utils.weights_store, a pickled model, a
+    TorchScript archive or an ONNX file (see romiseg.utils.export), the latter is run by
+    onnxruntime on CPU"""
+    if weights_store.is_state_dict(model_path):
+        return weights_store.load_weights(model_path, device)
+    if is_onnx(model_path):
+        return OnnxRuntimeModel(model_path)
+    if is_torchscript(model_path):
+        return load_torchscript(model_path, device)
+
+    options = {'weights_only': False} if 'weights_only' in inspect.signature(torch.load).parameters else {}
+    model_segmentation = torch.load(model_path, map_location = device, **options)[0]
     
     try: 
         model_segmentation = model_segmentation.module
     except:
         model_segmentation = model_segmentation
             
-    return model_segmentation
+    return model_segmentation.to(device).eval()
+
+def save_and_load_model(weights_folder, model_segmentation_name, device = device, cache = True,
+                        backend = None, optimize = False):
+    """Loads the model model_segmentation_name from weights_folder, a mirror directory or
+    db.romi-project.eu (see romiseg.utils.weights_store.resolve), and converts it to backend
+    ('eager', 'torchscript' or 'onnxruntime', see romiseg.utils.backends; None: the backend of
+    the weights file).
+    With optimize = True an eager model is replaced by its BatchNorm folded, channels last, frozen
+    graph (see romiseg.utils.optimization.optimize_for_inference), for inference only.
+    With cache = True the model is kept in model_registry and later calls in the same process
+    return the same (eval mode) model. Use cache = False to get a private copy, e.g. to train it.
+    """
+    model_path = weights_store.resolve(weights_folder, model_segmentation_name)
+
+    def load():
+        model = to_backend(load_model(model_path, device), backend, device)
+        return optimize_for_inference(model) if optimize else model
+    if not cache:
+        return load()
+    return model_registry.get(model_path, load, device, (backend, optimize))
 
 
 
@@ -77,7 +94,8 @@ def save_and_load_model(weights_folder, model_segmentation_name):
 
 
 def dice_loss(pred, target, smooth = 1.):
-    pred = pred.contiguous()
+    #sums over whole images, always computed in float32
+    pred = pred.float().contiguous()
     target = target.contiguous()    
 
     intersection = (pred * target).sum(dim=2).sum(dim=2)
@@ -96,6 +114,8 @@ def my_metric(outputs: torch.Tensor, labels: torch.Tensor):
 
 
 def calc_loss(pred, target, metrics, bce_weight=0.5):
+    pred = pred.float() #outputs of reduced precision forward passes
+    target = target.float()
     bce = F.binary_cross_entropy_with_logits(pred, target)
 
     pred = F.sigmoid(pred)
@@ -109,6 +129,29 @@ def calc_loss(pred, target, metrics, bce_weight=0.5):
 
     return loss
 
+def distillation_loss(pred, teacher_pred, target, metrics, alpha = 0.5, temperature = 1., bce_weight = 0.5):
+    """Loss of a student network pred trained on the soft masks of a teacher network teacher_pred
+    (logits) and on the ground truth target: alpha * soft loss + (1 - alpha) * calc_loss.
+    The soft loss is the binary cross entropy between the sigmoids of the logits divided by
+    temperature, multiplied by temperature**2 so that its gradients keep their scale."""
+    pred = pred.float()
+    soft_target = F.sigmoid(teacher_pred.float() / temperature)
+    distill = F.binary_cross_entropy_with_logits(pred / temperature, soft_target) * temperature**2
+    hard = calc_loss(pred, target, metrics, bce_weight)
+    loss = alpha * distill + (1 - alpha) * hard
+
+    metrics['distill'] += distill.data.cpu().numpy() * target.size(0)
+    metrics['total'] += loss.data.cpu().numpy() * target.size(0)
+
+    return loss
+
+def load_teacher(weights_folder, model_segmentation_name, device = device):
+    """Loads a trained model as the frozen teacher of a distillation (see train_model)"""
+    teacher = save_and_load_model(weights_folder, model_segmentation_name, device, cache = False)
+    for param in getattr(teacher, 'parameters', lambda: [])():
+        param.requires_grad = False
+    return teacher.eval()
+
 def print_metrics(metrics, epoch_samples, phase):
     outputs = []
     for k in metrics.keys():
@@ -116,7 +159,15 @@ def print_metrics(metrics, epoch_samples, phase):
 
     print("{}: {}".format(phase, ", ".join(outputs)))
 
-def train_model(dataloaders, model, optimizer, scheduler, writer, num_epochs=25, viz = False, label_names = []):
+def train_model(dataloaders, model, optimizer, scheduler, writer, num_epochs=25, viz = False, label_names = [],
+                precision = 'float32', teacher = None, distill_alpha = 0.5, distill_temperature = 1.):
+    """precision: 'float32', or 'bfloat16' to run the forward passes under autocast
+    (the losses are computed in float32)
+    teacher: frozen network (see load_teacher) distilled into model: model is trained on
+    distillation_loss, mixing the soft masks of the teacher (weight distill_alpha) and the
+    ground truth. The best model is still selected on the ground truth loss of the validation set."""
+    if teacher is not None:
+        teacher.eval()
     L = []
     best_model_wts = copy.deepcopy(model.state_dict())
     best_loss = 1e10
@@ -144,7 +195,7 @@ def train_model(dataloaders, model, optimizer, scheduler, writer, num_epochs=25,
             
 
             for inputs, labels in tqdm(dataloaders[phase]):
-                inputs = inputs.to(device)
+                inputs = to_float_batch(inputs, device)
                 labels = labels.to(device)
 
                 # zero the parameter gradients
@@ -153,8 +204,15 @@ def train_model(dataloaders, model, optimizer, scheduler, writer, num_epochs=25,
                 # forward
                 # track history if only in train
                 with torch.set_grad_enabled(phase == 'train'):
-                    outputs = model(inputs)
-                    loss = calc_loss(outputs, labels, metrics)
+                    with autocast(precision, device):
+                        outputs = model(inputs)
+                    if teacher is None:
+                        loss = calc_loss(outputs, labels, metrics)
+                    else:
+                        with torch.no_grad(), autocast(precision, device):
+                            teacher_outputs = teacher(inputs)
+                        loss = distillation_loss(outputs, teacher_outputs, labels, metrics,
+                                                 distill_alpha, distill_temperature)
                     #print(loss)
                     # backward + optimize only if in training phase
                     if phase == 'train':
@@ -168,15 +226,20 @@ def train_model(dataloaders, model, optimizer, scheduler, writer, num_epochs=25,
             epoch_loss = metrics['loss'] / epoch_samples
             L.append(epoch_loss)
             writer.add_scalar('train/crossentropy', epoch_loss, epoch)
+            if teacher is not None:
+                writer.add_scalar('%s/distill'%phase, metrics['distill'] / epoch_samples, epoch)
+                writer.add_scalar('%s/total'%phase, metrics['total'] / epoch_samples, epoch)
         
             if phase == 'val':
                 inputs, labels = next(iter(dataloaders[phase]))
-                inputs = inputs.to(device)
+                inputs = to_float_batch(inputs, device)
                 labels = labels.to(device)
                 lab = torch.argmax(labels, dim = 1)
                 # forward
                 # track history if only in train
-                outputs = model(inputs)
+                with torch.no_grad(), autocast(precision, device):
+                    outputs = model(inputs)
+                outputs = outputs.float()
                 out = torch.argmax(outputs, dim = 1)
                 loss_test.append(my_metric(out, lab))
                 
@@ -188,6 +251,7 @@ def train_model(dataloaders, model, optimizer, scheduler, writer, num_epochs=25,
         
             #plot 4 images to visualize the data
         if viz == True:
+            import matplotlib.pyplot as plt
  
             plt.ioff()
             fig = plt.figure(figsize = (14, 6))
@@ -230,6 +294,10 @@ def train_model(dataloaders, model, optimizer, scheduler, writer, num_epochs=25,
 
 def fine_tune_train(path_train, path_val, weights_folder, label_names, tsboard_name,
                     model_segmentation_name, Sx, Sy, num_epochs, scan):
+    import matplotlib.pyplot as plt
+    from torch.utils.tensorboard import SummaryWriter
+    from romiseg.utils.dataloader_finetune import Dataset_im_label, plot_dataset, init_set
+
     num_classes = len(label_names)
     
     trans = transforms.Compose([
@@ -240,8 +308,8 @@ def fine_tune_train(path_train, path_val, weights_folder, label_names, tsboard_n
     image_train, target_train = init_set('', path_train, 'jpg')
     image_val, target_val = init_set('', path_val, 'jpg')
 
-    train_dataset = Dataset_im_label(image_train, target_train, transform = trans)
-    val_dataset = Dataset_im_label(image_val, target_val, transform = trans) 
+    train_dataset = Dataset_im_label(image_train, target_train, transform = trans, crop = (Sx, Sy))
+    val_dataset = Dataset_im_label(image_val, target_val, transform = trans, crop = (Sx, Sy)) 
     
         
     batch_size = min(num_classes, len(image_train))
@@ -261,7 +329,7 @@ def fine_tune_train(path_train, path_val, weights_folder, label_names, tsboard_n
         }
     
     
-    model = save_and_load_model(weights_folder, model_segmentation_name)
+    model = save_and_load_model(weights_folder, model_segmentation_name, cache = False) #trained below
 
     
     writer = SummaryWriter('test')#tsboard_name)
@@ -279,9 +347,9 @@ def fine_tune_train(path_train, path_val, weights_folder, label_names, tsboard_n
     
     model = train_model(dataloaders, model, optimizer_ft, exp_lr_scheduler, writer,  num_epochs = num_epochs)
     ext_name = '_finetune_' + scan + '_epoch%d.pt'%num_epochs
-    new_model_name = model_segmentation_name[:-3] + ext_name
+    new_model_name = os.path.splitext(model_segmentation_name)[0] + ext_name
 
-    torch.save(model, weights_folder + '/' + new_model_name)
+    weights_store.save_weights(model, weights_folder + '/' + new_model_name, label_names = list(label_names))
     
     
     return model, new_model_name
@@ -291,14 +359,20 @@ def fine_tune_train(path_train, path_val, weights_folder, label_names, tsboard_n
 
     
 # Prediction
-def evaluate(inputs, model):
+def evaluate(inputs, model, precision = 'float32', size = None):
+    """Class probabilities of the model on inputs. If size = (Sx, Sy) is given, the logits are
+    bilinearly upsampled to size before the sigmoid (inputs segmented at a reduced resolution)"""
 
     with torch.no_grad():
         inputs.requires_grad = False
         # Get the first batch
-        inputs = inputs.to(device)
+        inputs = to_float_batch(inputs, device)
 
-        pred = model(inputs)
+        with autocast(precision, inputs.device):
+            pred = model(inputs)
+        pred = pred.float()
+        if size is not None and tuple(pred.shape[-2:]) != tuple(size):
+            pred = F.interpolate(pred, size = tuple(size), mode = 'bilinear', align_corners = False)
         # The loss functions include the sigmoid function.
         pred = F.sigmoid(pred)
         
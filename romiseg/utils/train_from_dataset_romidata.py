@@ -20,6 +20,7 @@ from PIL import Image
 from tqdm import tqdm
 
 from romiseg.utils.dataloader_finetune import plot_dataset
+from romiseg.utils.image_decode import crop_array
 import romiseg.utils.alienlab as alien
 
 from romidata import io
@@ -265,22 +266,24 @@ def init_set(mode, path):
 class Dataset_im_label(Dataset):
     """Data handling for Pytorch Dataloader"""
 
-    def __init__(self, image_paths, label_paths, transform):
+    def __init__(self, image_paths, label_paths, transform, crop = None):
 
         self.image_paths = image_paths
         self.label_paths = label_paths
         self.transforms = transform
+        self.crop = crop #crop = (Sx, Sy): center crop by slicing, without PIL round trip
 
 
     def __getitem__(self, index):
 
         db_file = self.image_paths[index]
-        image = Image.fromarray(io.read_image(db_file))
-        #id_im = db_file.id
-        t_image = transforms.ColorJitter(brightness=0, contrast=0, saturation=0, hue=0)(image)
-        t_image = self.transforms(image) #crop the images
-
-        t_image = t_image[0:3, :, :] #select RGB channels
+        if self.crop is None:
+            image = Image.fromarray(io.read_image(db_file))
+            t_image = self.transforms(image) #crop the images
+            t_image = t_image[0:3, :, :] #select RGB channels
+        else:
+            #float here, the noise augmentation below needs it
+            t_image = crop_array(np.asarray(io.read_image(db_file)), self.crop).float().div_(255)
 
         db_file = self.label_paths[index]
         npz = io.read_npz(db_file)
@@ -339,8 +342,8 @@ def fine_tune_train(path_train, path_val, weights_folder, label_names, tsboard_n
     image_train, target_train = init_set('', path_train)
     image_val, target_val = init_set('', path_val)
 
-    train_dataset = Dataset_im_label(image_train, target_train, transform = trans)
-    val_dataset = Dataset_im_label(image_val, target_val, transform = trans) 
+    train_dataset = Dataset_im_label(image_train, target_train, transform = trans, crop = (Sx, Sy))
+    val_dataset = Dataset_im_label(image_val, target_val, transform = trans, crop = (Sx, Sy)) 
     
         
     batch_size = min(num_classes, len(image_train))
@@ -10,14 +10,15 @@ import os#, subprocess
 
 # Import functions to read and write ply files
 from romiseg.utils.ply import write_ply, read_ply
+from romiseg.utils.precision import prediction_scale
+from romiseg.utils.profiling import profiler
 import torch
 
 import numpy as np
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D
 
-from PIL import Image
-import imageio
+#voxels projected at once by project_flat_coordinates: the float64 intermediates hold
+#N_cam * 3 * CHUNK_SIZE values (7 MB each for 72 views) whatever the size of the volume
+CHUNK_SIZE = int(os.environ.get('ROMISEG_VOXEL_CHUNK', 4096))
 
 def avoid_eps(a, eps):
     a[torch.abs(a)<eps] = 0
@@ -65,6 +66,15 @@ def get_int(fx, fy, cx, cy):
     intri = torch.tensor([[fx, 0, cx],[0,fy,cy],[0,0,1]])
     return intri
 
+def scale_intrinsics(intrinsics, scale):
+    '''Intrinsics of the images resized by scale, e.g. predictions kept at low resolution
+    by segmentation(..., scale = scale, upsample = False).
+    The projected coordinates are truncated to pixel indices (pixel i covers [i, i + 1[):
+    the focals and the optical center are simply multiplied by scale.'''
+    intrinsics = intrinsics.clone()
+    intrinsics[..., 0:2, :] *= scale
+    return intrinsics
+
 def get_extr(rx, ry, rz, x, y, z):
     rt = torch.zeros((3,4))
 
@@ -185,16 +195,14 @@ def adjust_predictions(preds):
     These voxels will project onto the last element of the flattened predictions
     that correspond to "pixel outside the image" class.
     Input: predictions in shape (N_cam, W, H, num_labels) torch tensor
-    Output: Flattened predictions (N_cam * W * H + 1, num_labels + 1)
+    Output: Flattened predictions (N_cam * W * H + 1, num_labels + 1), same dtype as the input
     '''
-    outside_proj_label = (preds[:,:,:,0]*0).unsqueeze(-1) 
-    preds = torch.cat([preds, outside_proj_label], dim = 3) #Add a label class: voxel projects outside image
-    preds_flat = torch.flatten(preds, end_dim = -2) #Flatten the predictions
-    
-    outside_label = preds_flat[0] * 0
-    outside_label[-1] = 1 
-    outside_label = outside_label.unsqueeze(0)
-    preds_flat = torch.cat([preds_flat, outside_label]) #Add a last prediction where all 
+    num_labels = preds.shape[-1]
+    #single allocation, the predictions are copied once
+    preds_flat = preds.new_zeros((preds[..., 0].numel() + 1, num_labels + 1)) #Add a label class: voxel projects outside image
+    preds_flat[:-1, :-1].view(preds.shape).copy_(preds) #Flatten the predictions
+    
+    preds_flat[-1, -1] = prediction_scale(preds.dtype) #Add a last prediction where all 
     #voxels that project outside the  image will collect their class
     
     return preds_flat
@@ -222,4 +230,45 @@ def flatten_coordinates(coords, shape_predictions):
     xy_full_flat = torch.flatten(flat_coo)
     
     
-    return xy_full_flat
\ No newline at end of file
+    return xy_full_flat
+
+
+def voxel_chunks(n_vox, chunk_size = None):
+    '''Slices of chunk_size consecutive voxels (default CHUNK_SIZE) covering n_vox voxels'''
+    chunk_size = CHUNK_SIZE if chunk_size is None else max(1, int(chunk_size))
+    for start in range(0, n_vox, chunk_size):
+        yield slice(start, min(start + chunk_size, n_vox))
+
+
+def project_flat_coordinates(torch_voxels, intrinsics, extrinsics, shape_predictions, Sx, Sy, xinit, yinit,
+                             chunk_size = None, out = None):
+    '''
+    Indexes of the voxels in the flattened predictions of each view: projection, x and y
+    permutation, correct_coords_outside and flatten_coordinates applied by chunks of
+    chunk_size voxels (see voxel_chunks), so that the peak memory does not depend on the
+    number of voxels.
+    Inputs: -voxels (N_vox, 4) torch tensor
+            -intrinsics and extrinsics of the N_cam views
+            -shape of the predictions before flattening
+            -center crop dimensions
+            -image dimensions
+            -out: preallocated (N_cam * N_vox) long tensor, allocated if None
+    Output: out, same values as flatten_coordinates on the whole volume
+    '''
+    n_cam = shape_predictions[0]
+    n_vox = torch_voxels.shape[0]
+    if out is None:
+        out = torch.empty(n_cam * n_vox, dtype = torch.long, device = torch_voxels.device)
+    out_views = out.view(n_cam, n_vox)
+    for chunk in voxel_chunks(n_vox, chunk_size):
+        n = chunk.stop - chunk.start
+        with profiler.stage('projection', n):
+            xy_coords = project_coordinates(torch_voxels[chunk], intrinsics, extrinsics, give_prod = False)
+            #permute x and y coordinates
+            xy_coords[:, 2, :] = xy_coords[:,0,:]
+            xy_coords[:, 0, :] = xy_coords[:,1,:]
+            xy_coords[:, 1, :] = xy_coords[:,2,:]
+            coords = correct_coords_outside(xy_coords, Sx, Sy, xinit, yinit, -1) #correct the coordinates that project outside
+        with profiler.stage('flatten', n):
+            out_views[:, chunk] = flatten_coordinates(coords, shape_predictions).view(n_cam, n)
+    return out
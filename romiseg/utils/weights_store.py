@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Store of the segmentation network weights.
+
+A model is saved as its state_dict (weights_file) next to a JSON sidecar
+(weights_file + '.json') holding the architecture, its arguments and the
+sha256 of the weights file:
+
+    {"format": "state_dict", "architecture": "ResNetUNet",
+     "arguments": {"n_class": 6, "backbone": "resnet101"}, "sha256": "..."}
+
+Loading rebuilds the network without pretrained downloads, checks the hash
+and maps the tensors of the file in memory (torch.load(mmap = True)): the
+worker processes loading the same weights share the page cache instead of
+holding a private copy each. Pickled models (torch.save(model)) without
+sidecar are still loaded as before.
+
+Weights are looked up in the weights folder, then in the mirror directories
+listed in the ROMISEG_WEIGHTS_MIRROR environment variable (separated by
+os.pathsep), and only then downloaded from ROMISEG_WEIGHTS_URL (default
+http://db.romi-project.eu/models/). Downloads go to a temporary file which is
+renamed once complete and verified, the sidecar is only written next to
+verified weights. With ROMISEG_OFFLINE=1 nothing is
+downloaded: a missing model raises FileNotFoundError, as it does when the
+server cannot be reached. The requests time out after TIMEOUT (connection,
+read) seconds, so an unreachable server does not block the lookup.
+"""
+
+import inspect
+import json
+import os
+import tempfile
+
+import torch
+
+from romiseg.utils.hashing import file_digest
+
+
+DEFAULT_URL = 'http://db.romi-project.eu/models/'
+TIMEOUT = (10, 60) #seconds: connection, read (between two chunks)
+
+#torch >= 2.1
+_MMAP = 'mmap' in inspect.signature(torch.load).parameters
+
+
+def architectures():
+    """Network classes that can be rebuilt from a sidecar, by name"""
+    from romiseg.utils.segmentation_model import ResNetUNet
+    return {'ResNetUNet': ResNetUNet}
+
+
+def sidecar_path(weights_path):
+    return weights_path + '.json'
+
+
+def is_state_dict(weights_path):
+    """True if weights_path was saved by save_weights (it has a sidecar)"""
+    return os.path.isfile(sidecar_path(weights_path))
+
+
+def read_sidecar(weights_path):
+    with open(sidecar_path(weights_path)) as f:
+        return json.load(f)
+
+
+def architecture_arguments(model):
+    """Arguments rebuilding the architecture of model"""
+    arguments = {'n_class': model.conv_last.out_channels, 'backbone': getattr(model, 'backbone', 'resnet101')}
+    if getattr(model, 'widths', None):
+        arguments['widths'] = model.widths #pruned network
+    return arguments
+
+
+def _atomic_write(path, write, mode = 'wb', check = None):
+    """Calls write(f) on a temporary file of the directory of path, renamed to path once complete
+    (and check(temporary path) passed)"""
+    fd, tmp = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(path)), suffix = '.tmp')
+    try:
+        with os.fdopen(fd, mode) as f:
+            write(f)
+        if check is not None:
+            check(tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def save_weights(model, weights_path, **metadata):
+    """Saves the state_dict of model in weights_path and its sidecar, metadata (e.g. label_names)
+    is added to the sidecar. Returns the sidecar."""
+    if isinstance(model, (list, tuple)):
+        model = model[0]
+    model = getattr(model, 'module', model) #DataParallel
+    state = {k: v.detach().cpu() for k, v in model.state_dict().items()}
+    _atomic_write(weights_path, lambda f: torch.save(state, f))
+    sidecar = dict(metadata, format = 'state_dict', architecture = type(model).__name__,
+                   arguments = architecture_arguments(model), sha256 = file_digest(weights_path))
+    _atomic_write(sidecar_path(weights_path), lambda f: json.dump(sidecar, f, indent = 2), 'w')
+    return sidecar
+
+
+def verify(weights_path, sha256):
+    """Raises ValueError if the content of weights_path does not match sha256"""
+    digest = file_digest(weights_path)
+    if digest != sha256:
+        raise ValueError('%s is corrupted: sha256 %s, expected %s'%(weights_path, digest, sha256))
+
+
+def load_weights(weights_path, device = 'cpu', check = True):
+    """Rebuilds the model saved by save_weights in weights_path on device, in eval mode.
+    On CPU the tensors stay mapped from the file."""
+    sidecar = read_sidecar(weights_path)
+    if check:
+        verify(weights_path, sidecar['sha256'])
+    model_class = architectures().get(sidecar['architecture'])
+    if model_class is None:
+        raise ValueError('unknown architecture %s in %s'%(sidecar['architecture'], sidecar_path(weights_path)))
+    if _MMAP:
+        #built without initializing its weights, the parameters are the tensors mapped from the file
+        with torch.device('meta'):
+            model = model_class(pretrained = False, **sidecar['arguments'])
+        state = torch.load(weights_path, map_location = 'cpu', mmap = True, weights_only = True)
+        model.load_state_dict(state, assign = True)
+    else:
+        model = model_class(pretrained = False, **sidecar['arguments'])
+        model.load_state_dict(torch.load(weights_path, map_location = 'cpu'))
+    return model.to(device).eval()
+
+
+def download(url, target_dir, sha256 = None, timeout = TIMEOUT):
+    """Downloads url in target_dir, verified against sha256 if given. Returns the file path.
+    Raises requests.exceptions.RequestException when the server fails or times out."""
+    import requests
+    path = os.path.join(target_dir, url.split('/')[-1])
+    with requests.get(url, stream = True, timeout = timeout) as r:
+        r.raise_for_status()
+        def write(f):
+            for chunk in r.iter_content(chunk_size = 2**20):
+                if chunk: # filter out keep-alive new chunks
+                    f.write(chunk)
+        _atomic_write(path, write, check = None if sha256 is None else lambda tmp: verify(tmp, sha256))
+    return path
+
+
+def mirrors():
+    return [d for d in os.environ.get('ROMISEG_WEIGHTS_MIRROR', '').split(os.pathsep) if d]
+
+
+def resolve(weights_folder, model_name):
+    """Path of the weights model_name: found in weights_folder or in a mirror directory, or
+    downloaded in weights_folder (with its sidecar, if the server has one).
+    Raises FileNotFoundError if it is not found locally and cannot be downloaded."""
+    directories = [weights_folder] + mirrors()
+    for directory in directories:
+        path = os.path.join(directory, model_name)
+        if os.path.isfile(path):
+            return path
+
+    if os.environ.get('ROMISEG_OFFLINE', '0') not in ('', '0'):
+        raise FileNotFoundError('%s not found in %s (offline)'%(model_name, directories))
+
+    import requests
+    url = os.environ.get('ROMISEG_WEIGHTS_URL', DEFAULT_URL).rstrip('/') + '/' + model_name
+    #the sidecar is kept in memory and only written once the weights are downloaded and verified:
+    #a failed download leaves no sidecar behind
+    sidecar = None
+    try:
+        r = requests.get(sidecar_path(url), timeout = TIMEOUT)
+        if r.ok:
+            sidecar = r.content
+        #else pickled model, without sidecar
+        path = download(url, weights_folder, None if sidecar is None else json.loads(sidecar)['sha256'])
+    except requests.exceptions.RequestException as e:
+        #server unreachable, timed out or without the model
+        raise FileNotFoundError('%s not found in %s and not downloaded from %s: %s'
+                                %(model_name, directories, url, e)) from e
+    if sidecar is not None:
+        _atomic_write(sidecar_path(path), lambda f: f.write(sidecar))
+    return path
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Throughput and accuracy of the segmentation at reduced resolution.
+
+The images of a reference scan are segmented at each scale, the label maps
+of the center crop are compared to the full resolution ones (per class IoU)
+and the throughput is measured:
+
+    python scale_benchmark.py --weights WEIGHTS_FOLDER --model MODEL_NAME.pt --db DB_PATH --scan SCAN_ID --scales 1,0.75,0.5,0.25
+"""
+
+import argparse
+import json
+import time
+
+import torch
+
+from romidata import fsdb
+
+from romiseg.Segmentation2D import segmentation_stream, load_segmentation_model
+from romiseg.utils.evaluation import iou_counts, iou_from_counts
+
+
+def label_maps(images, Sx, Sy, label_names, model, weights, scale, **options):
+    """Label maps of the center crop of the images segmented at scale, and segmentation time"""
+    maps = []
+    t0 = time.perf_counter()
+    for id_im, pred in segmentation_stream(Sx, Sy, label_names, images, None, model, weights,
+                                           scale = scale, **options):
+        xinit, yinit = pred.shape[1:]
+        x0, y0 = (xinit - Sx) // 2, (yinit - Sy) // 2
+        maps.append(torch.argmax(pred[:, x0:x0 + Sx, y0:y0 + Sy], dim = 0).to(torch.uint8))
+    return maps, time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Segmentation throughput and IoU versus scale.')
+    parser.add_argument('--weights', dest='weights', required=True,
+                        help='folder of the model weights')
+    parser.add_argument('--model', dest='model', required=True,
+                        help='name of the model in the weights folder')
+    parser.add_argument('--db', dest='db', required=True,
+                        help='FSDB holding the reference scan')
+    parser.add_argument('--scan', dest='scan', required=True,
+                        help='id of the reference scan')
+    parser.add_argument('--fileset', dest='fileset', default='images')
+    parser.add_argument('--labels', dest='labels', default='background,flower,peduncle,stem,leaf,fruit',
+                        help='comma separated label names')
+    parser.add_argument('--Sx', dest='Sx', type=int, default=896)
+    parser.add_argument('--Sy', dest='Sy', type=int, default=896)
+    parser.add_argument('--scales', dest='scales', default='1,0.75,0.5,0.25',
+                        help='comma separated scales, compared to the first one')
+    parser.add_argument('--batch_size', dest='batch_size', type=int, default=1)
+    parser.add_argument('--num_workers', dest='num_workers', type=int, default=0)
+    parser.add_argument('--output', dest='output', default=None,
+                        help='JSON file receiving the results')
+    args = parser.parse_args()
+
+    label_names = args.labels.split(',')
+    scales = [float(s) for s in args.scales.split(',')]
+    options = {'batch_size': args.batch_size, 'num_workers': args.num_workers}
+
+    db = fsdb.FSDB(args.db)
+    db.connect()
+    images = db.get_scan(args.scan).get_fileset(args.fileset).get_files()
+    images = [f for f in images if f.get_metadata('channel') in (None, 'rgb')]
+
+    #model loading is not timed: the model segmentation() will use is loaded in the registry
+    load_segmentation_model(args.weights, args.model, **options)
+    results = []
+    reference = None
+    for scale in scales:
+        #warm up
+        label_maps(images[:1], args.Sx, args.Sy, label_names, args.model, args.weights, scale, **options)
+        maps, seconds = label_maps(images, args.Sx, args.Sy, label_names, args.model, args.weights,
+                                   scale, **options)
+        result = {'scale': scale, 'seconds': seconds, 'images_per_second': len(images) / seconds}
+        if reference is None:
+            reference = maps
+        else:
+            inter = torch.zeros(len(label_names), dtype = torch.long)
+            union = torch.zeros(len(label_names), dtype = torch.long)
+            for m, r in zip(maps, reference):
+                i, u = iou_counts(m, r, len(label_names))
+                inter += i
+                union += u
+            iou = iou_from_counts(inter, union)
+            valid = [v for v in iou if v is not None]
+            result['iou'] = dict(zip(label_names, iou))
+            result['mean_iou'] = sum(valid) / len(valid) if valid else None
+        results.append(result)
+        print('scale %.3g: %.2f images/s, mean IoU %s'%(scale, result['images_per_second'],
+              '%.4f'%result['mean_iou'] if result.get('mean_iou') is not None else '-'))
+    db.disconnect()
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'scan': args.scan, 'model': args.model, 'Sx': args.Sx, 'Sy': args.Sy,
+                       'reference_scale': scales[0], 'results': results}, f, indent = 2)
+
+
+if __name__ == '__main__':
+    main()
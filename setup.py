@@ -44,7 +44,9 @@ install_requires=[
 s = setup(
     name='romiseg',
     version='0.0.1',
-    scripts=['romiseg/finetune.py'],
+    scripts=['romiseg/finetune.py', 'romiseg/export_model.py',
+             'romiseg/quantize_model.py', 'romiseg/prune_model.py',
+             'romiseg/segmentation_server.py'],
     packages=find_packages(),
     author='Alienor Lahlou',
     author_email='alienor.lahlou@espci.org',
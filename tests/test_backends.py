@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the export formats and inference backends (romiseg.utils.export, romiseg.utils.backends).
+"""
+
+import pytest
+import torch
+
+from romiseg.utils.backends import BACKENDS, model_backend, to_backend
+from romiseg.utils.export import export_torchscript, is_onnx, is_torchscript, load_torchscript
+
+
+def small_network():
+    """Fully convolutional network standing for the UNet"""
+    torch.manual_seed(0)
+    return torch.nn.Sequential(torch.nn.Conv2d(3, 8, 3, padding = 1), torch.nn.BatchNorm2d(8), torch.nn.ReLU(),
+                               torch.nn.Conv2d(8, 4, 1)).eval()
+
+
+def test_file_formats(tmp_path):
+    model = small_network()
+    pickled, archive = str(tmp_path / 'model.pt'), str(tmp_path / 'model.ts')
+    torch.save(model, pickled)
+    export_torchscript(model, archive, 32, 32)
+    assert not is_torchscript(pickled) and is_torchscript(archive)
+    assert is_onnx('model.onnx') and is_onnx('MODEL.ONNX') and not is_onnx(archive)
+    inputs = torch.rand(2, 3, 64, 96)
+    with torch.no_grad():
+        assert torch.allclose(load_torchscript(archive)(inputs), model(inputs), atol = 1e-5)
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_backends_agree_on_any_size(backend):
+    if backend == 'onnxruntime':
+        pytest.importorskip('onnxruntime')
+    model = small_network()
+    converted = to_backend(model, backend)
+    assert model_backend(converted) == backend
+    for shape in [(1, 3, 64, 64), (3, 3, 96, 128)]:
+        inputs = torch.rand(*shape)
+        with torch.no_grad():
+            assert torch.allclose(converted(inputs), model(inputs), atol = 1e-4)
+
+
+def test_backend_conversions():
+    model = small_network()
+    assert to_backend(model) is model
+    scripted = to_backend(model, 'torchscript')
+    assert to_backend(scripted, 'torchscript') is scripted
+    with pytest.raises(ValueError):
+        to_backend(scripted, 'eager')
+    with pytest.raises(ValueError):
+        to_backend(model, 'tensorrt')
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the vegetation pre-filter (romiseg.utils.foreground).
+"""
+
+import torch
+
+from romiseg.utils.foreground import channel_maxima, exgreen, foreground_mask, has_foreground
+from romiseg.utils.tiling import tiled_predict
+
+
+def scene():
+    """64x64 uint8 image: white backdrop, plant in the top left quarter (a few brighter leaf pixels)"""
+    image = torch.full((3, 64, 64), 255, dtype = torch.uint8)
+    image[:, :32, :32] = torch.tensor([40, 120, 30], dtype = torch.uint8)[:, None, None]
+    image[:, 10:12, 10:12] = torch.tensor([60, 160, 50], dtype = torch.uint8)[:, None, None]
+    return image
+
+
+def test_exgreen_values():
+    images = torch.stack([scene(), torch.zeros(3, 64, 64, dtype = torch.uint8)])
+    maxima = channel_maxima(images)
+    assert maxima.shape == (2, 3)
+    index = exgreen(images)
+    assert torch.allclose(index, exgreen(images.float(), maxima = maxima))
+    assert torch.allclose(index[0, 40, 40], torch.tensor(0.)) #white: grey
+    assert torch.allclose(index[0, 0, 0], torch.tensor(3 * 120 / 190 - 1))
+    assert (index[1] == -1).all() #dark
+
+
+def test_tile_inside_the_vegetation_is_kept():
+    image = scene()
+    tile = image[:, :32, :32]
+    #normalized by its own maxima, the plant scores 0.11 only
+    assert not has_foreground(foreground_mask(tile))
+    assert foreground_mask(tile, maxima = channel_maxima(image)).all()
+    keep = lambda image: (lambda tile: bool(has_foreground(foreground_mask(tile, maxima = channel_maxima(image)))))
+    predicted = []
+    def predict(tiles):
+        predicted.extend(tiles)
+        return torch.zeros(len(tiles), 2, 32, 32)
+    out = torch.zeros(2, 64, 64)
+    done = list(tiled_predict([(image[None], ['a'])], predict, (64, 64), (32, 32), lambda index: out,
+                              overlap = 0., blending = 'uniform', keep = keep))
+    assert done == [(0, 'a')]
+    #only the plant tile goes through the network, the backdrop tiles are background
+    assert len(predicted) == 1 and torch.equal(predicted[0], tile)
+    assert (out[0, :32, :32] == 0).all() and (out[0, 32:] == 1).all() and (out[0, :, 32:] == 1).all()
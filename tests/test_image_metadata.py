@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the image size probing (romiseg.utils.image_metadata).
+"""
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from romiseg.utils import image_metadata
+
+
+class DbFile(object):
+    """File of a fileset: a path and its metadata"""
+
+    def __init__(self, path, metadata = None):
+        self.path = path
+        self.metadata = metadata or {}
+
+    def get_metadata(self, key):
+        return self.metadata.get(key)
+
+
+@pytest.fixture
+def files(tmp_path, monkeypatch):
+    monkeypatch.setattr(image_metadata, '_file_path', lambda db_file: db_file.path)
+    def make(name, height, width):
+        path = str(tmp_path / name)
+        Image.fromarray(np.zeros((height, width, 3), dtype = np.uint8)).save(path)
+        return DbFile(path)
+    return make
+
+
+@pytest.mark.parametrize('name', ['image.png', 'image.jpg'])
+def test_header_size_is_height_width(files, name):
+    assert image_metadata.header_size(files(name, 48, 80).path) == (48, 80)
+
+
+def test_metadata_size_fallback(tmp_path, monkeypatch):
+    monkeypatch.setattr(image_metadata, '_file_path', lambda db_file: db_file.path)
+    for name in ('broken.jpg', 'no_metadata.jpg'):
+        (tmp_path / name).write_bytes(b'not an image')
+    camera = {'camera_model': {'height': 1080, 'width': 1920}}
+    assert image_metadata.image_size(DbFile(str(tmp_path / 'broken.jpg'), {'camera': camera})) == (1080, 1920)
+    with pytest.raises(OSError):
+        image_metadata.image_size(DbFile(str(tmp_path / 'no_metadata.jpg')))
+
+
+def test_bucket_by_size_keeps_the_order(files):
+    images = [files('a.png', 32, 64), files('b.png', 64, 32), files('c.png', 32, 64)]
+    buckets = image_metadata.bucket_by_size(images)
+    assert list(buckets) == [(32, 64), (64, 32)]
+    assert [index for index, _ in buckets[(32, 64)]] == [0, 2]
+    with pytest.raises(ValueError):
+        image_metadata.fileset_image_size(images)
+    assert image_metadata.fileset_image_size(images[::2]) == (32, 64)
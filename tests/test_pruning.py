@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the channel pruning of the ResNetUNet decoder (romiseg.utils.pruning).
+"""
+
+import pytest
+import torch
+
+from romiseg.utils.pruning import DEFAULT_LAYERS, channel_importance, count_flops, prune_channels, prune_model
+from romiseg.utils.segmentation_model import ResNetUNet
+from romiseg.utils.weights_store import load_weights, save_weights
+
+
+@pytest.fixture(scope = 'module')
+def network():
+    torch.manual_seed(0)
+    model = ResNetUNet(3, pretrained = False, backbone = 'resnet18').eval()
+    batches = [torch.rand(2, 3, 64, 64) for _ in range(2)]
+    return model, batches
+
+
+def test_pruning_keeps_the_output_shape(network):
+    model, batches = network
+    pruned = prune_model(model, batches, ratio = 0.5, steps = 2)
+    assert set(pruned.widths) == set(DEFAULT_LAYERS)
+    for name in DEFAULT_LAYERS:
+        assert getattr(pruned, name)[0].out_channels == pruned.widths[name] < getattr(model, name)[0].out_channels
+    assert count_flops(pruned, 64, 64) < count_flops(model, 64, 64)
+    with torch.no_grad():
+        for inputs in batches:
+            assert pruned(inputs).shape == model(inputs).shape == (2, 3, 64, 64)
+    #the original model is left unchanged
+    assert not model.widths
+
+
+def test_no_pruning_is_the_identity(network):
+    model, batches = network
+    pruned = prune_channels(model, channel_importance(model, batches), ratio = 0)
+    with torch.no_grad():
+        for inputs in batches:
+            assert torch.equal(pruned(inputs), model(inputs))
+
+
+def test_pruned_weights_round_trip(network, tmp_path):
+    model, batches = network
+    pruned = prune_model(model, batches, ratio = 0.5, steps = 0)
+    path = str(tmp_path / 'pruned.pt')
+    sidecar = save_weights(pruned, path, label_names = ['background', 'leaf', 'stem'])
+    assert sidecar['arguments']['widths'] == pruned.widths
+    loaded = load_weights(path)
+    assert loaded.widths == pruned.widths
+    with torch.no_grad():
+        for inputs in batches:
+            assert torch.equal(loaded(inputs), pruned(inputs))
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the on-disk result cache (romiseg.utils.result_cache).
+"""
+
+import torch
+
+from romiseg.utils.result_cache import ResultCache, THROUGHPUT_OPTIONS
+
+
+def make_files(tmp_path):
+    weights = tmp_path / 'weights.pt'
+    weights.write_bytes(b'weights')
+    image = tmp_path / 'image.jpg'
+    image.write_bytes(b'image')
+    return str(weights), str(image)
+
+
+def test_key_ignores_the_throughput_options(tmp_path):
+    weights, image = make_files(tmp_path)
+    cache = ResultCache(str(tmp_path / 'cache'))
+    reference = cache.key(image, cache.context(weights, 896, 896, ['background', 'leaf'], precision = 'float32'))
+    for option in THROUGHPUT_OPTIONS:
+        context = cache.context(weights, 896, 896, ['background', 'leaf'], precision = 'float32', **{option: 8})
+        assert cache.key(image, context) == reference
+
+
+def test_key_depends_on_the_computation(tmp_path):
+    weights, image = make_files(tmp_path)
+    cache = ResultCache(str(tmp_path / 'cache'))
+    key = lambda *args, **options: cache.key(image, cache.context(weights, *args, **options))
+    reference = key(896, 896, ['background', 'leaf'])
+    assert key(896, 896, ['background', 'leaf']) == reference
+    assert key(448, 896, ['background', 'leaf']) != reference
+    assert key(896, 896, ['background', 'stem']) != reference
+    assert key(896, 896, ['background', 'leaf'], tiling = True) != reference
+    (tmp_path / 'image.jpg').write_bytes(b'other image')
+    assert key(896, 896, ['background', 'leaf']) != reference
+
+
+def test_put_get_and_eviction(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache'))
+    pred = torch.rand(3, 16, 16)
+    assert not cache.contains('a' * 64)
+    assert cache.get('a' * 64) is None
+    cache.put('a' * 64, pred)
+    assert cache.contains('a' * 64)
+    assert torch.equal(cache.get('a' * 64), pred)
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 2
+    #the most recent prediction is kept when the cap is exceeded
+    cache.max_bytes = 1
+    cache.put('b' * 64, pred)
+    assert not cache.contains('a' * 64) and cache.contains('b' * 64)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the segmentation service (romiseg.utils.server): socket protocol, job
+merging and error isolation. The FSDB access and the segmentation are replaced
+by stand-ins, only the service logic is tested.
+"""
+
+import sys
+import threading
+import time
+import types
+
+import pytest
+import torch
+
+from romiseg.utils import server
+from romiseg.utils.server import Job, SegmentationServer, submit
+
+
+SCANS = {'scan_a': 2, 'scan_b': 3, 'scan_c': 1} #images per scan
+
+
+class Image(object):
+    def __init__(self, id):
+        self.id = id
+
+
+@pytest.fixture
+def service(monkeypatch):
+    """Records the segmentation streams (image ids) and the written predictions (scan, image id)"""
+    record = types.SimpleNamespace(streams = [], written = [])
+
+    def open_scan(dbs, request):
+        if request['scan'] not in SCANS:
+            raise ValueError('scan %s not found in %s' % (request['scan'], request['db']))
+        return [Image('%s_%d' % (request['scan'], i)) for i in range(SCANS[request['scan']])], request['scan']
+
+    def segmentation_stream(Sx, Sy, label_names, images, scan, model, weights, return_index = False, **options):
+        record.streams.append([image.id for image in images])
+        for index, image in enumerate(images):
+            yield index, image.id, torch.zeros(len(label_names), 4, 4, dtype = torch.uint8)
+
+    monkeypatch.setattr(server, 'open_scan', open_scan)
+    monkeypatch.setattr(server, 'write_prediction',
+                        lambda output, id_im, pred, label_names: record.written.append((output, id_im)))
+    monkeypatch.setitem(sys.modules, 'romiseg.Segmentation2D',
+                        types.SimpleNamespace(segmentation_stream = segmentation_stream))
+    return record
+
+
+def request(scan, model = 'model.pt', **fields):
+    return dict({'db': '/db', 'scan': scan, 'model': model, 'labels': 'background,leaf'}, **fields)
+
+
+def start(srv):
+    """Runs srv in a thread, returns once it listens"""
+    thread = threading.Thread(target = srv.serve_forever, daemon = True)
+    thread.start()
+    for _ in range(200):
+        if srv._server is not None:
+            break
+        time.sleep(0.05)
+    return thread
+
+
+def test_bad_job_fails_alone(service):
+    jobs = [Job(request('scan_a')), Job(request('missing')), Job(request('scan_b'))]
+    SegmentationServer('unused', 'weights')._run(jobs)
+    assert [job.result['status'] for job in jobs] == ['ok', 'error', 'ok']
+    assert 'missing' in jobs[1].result['error']
+    assert [job.result['images'] for job in (jobs[0], jobs[2])] == [2, 3]
+    assert jobs[0].result['merged_jobs'] == 2
+    #one stream for the valid jobs, predictions written to the fileset of their scan
+    assert service.streams == [['scan_a_0', 'scan_a_1', 'scan_b_0', 'scan_b_1', 'scan_b_2']]
+    assert [output for output, _ in service.written] == ['scan_a'] * 2 + ['scan_b'] * 3
+
+
+def test_merging_keeps_the_arrival_order(service, tmp_path):
+    srv = SegmentationServer(str(tmp_path / 'seg.sock'), 'weights', max_merge = 2)
+    jobs = [Job(request(scan, model)) for scan, model in
+            [('scan_a', 'm1'), ('scan_b', 'm2'), ('scan_c', 'm1'), ('scan_a', 'm1'), ('scan_b', 'm2')]]
+    for job in jobs:
+        srv.jobs.put(job)
+    thread = start(srv)
+    try:
+        for job in jobs:
+            assert job.done.wait(10)
+    finally:
+        srv.shutdown()
+        thread.join(10)
+    #the oldest job goes first, with at most max_merge jobs of the same model
+    assert [stream[0] for stream in service.streams] == ['scan_a_0', 'scan_b_0', 'scan_a_0']
+    assert [job.result['merged_jobs'] for job in jobs] == [2, 2, 2, 1, 2]
+
+
+def test_socket_protocol(service, tmp_path):
+    path = str(tmp_path / 'seg.sock')
+    srv = SegmentationServer(path, 'weights')
+    thread = start(srv)
+    try:
+        result = submit(path, request('scan_b'), timeout = 10)
+        assert result['status'] == 'ok' and result['scan'] == 'scan_b' and result['images'] == 3
+        assert submit(path, request('missing'), timeout = 10)['status'] == 'error'
+        result = submit(path, {'scan': 'scan_a'}, timeout = 10)
+        assert result['status'] == 'error' and 'missing job fields' in result['error']
+        #a second server does not take over a live socket
+        with pytest.raises(RuntimeError):
+            SegmentationServer(path, 'weights').serve_forever()
+        assert submit(path, request('scan_c'), timeout = 10)['images'] == 1
+    finally:
+        srv.shutdown()
+        thread.join(10)
+    assert not (tmp_path / 'seg.sock').exists()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the sliding-window tiling (romiseg.utils.tiling).
+"""
+
+import pytest
+import torch
+
+from romiseg.utils.tiling import tile_origins, tile_grid, blending_weights, weight_sum, tiled_predict
+
+
+@pytest.mark.parametrize('size, tile, overlap', [(896, 896, 0.25), (1000, 256, 0.25), (1000, 256, 0.),
+                                                  (1080, 448, 0.5), (100, 256, 0.25), (257, 256, 0.9)])
+def test_tile_origins_cover_the_image(size, tile, overlap):
+    origins = tile_origins(size, tile, overlap)
+    assert origins[0] == 0
+    assert origins == sorted(set(origins))
+    assert origins[-1] + tile == max(size, tile) #the last tile is aligned with the end of the image
+    covered = torch.zeros(max(size, tile), dtype = torch.bool)
+    for x0 in origins:
+        covered[x0:x0 + tile] = True
+    assert covered[:size].all()
+    #consecutive tiles share at least overlap * tile pixels
+    for a, b in zip(origins, origins[1:]):
+        assert a + tile - b >= int(overlap * tile)
+
+
+@pytest.mark.parametrize('blending', ['uniform', 'linear', 'gaussian'])
+def test_blending_weights_sum_to_one(blending):
+    xinit, yinit, tile_size, overlap = 300, 200, (128, 96), 0.25
+    weights = blending_weights(*tile_size, blending)
+    assert (weights > 0).all()
+    norm = weight_sum(xinit, yinit, tile_size, overlap, weights)
+    tx, ty = tile_size
+    total = torch.zeros(xinit, yinit)
+    for x0, y0 in tile_grid(xinit, yinit, tile_size, overlap):
+        total[x0:x0 + tx, y0:y0 + ty] += weights[:xinit - x0, :yinit - y0] / norm[x0:x0 + tx, y0:y0 + ty]
+    assert torch.allclose(total, torch.ones(xinit, yinit))
+
+
+def test_blending_weights_unknown_mode():
+    with pytest.raises(ValueError):
+        blending_weights(32, 32, 'cubic')
+
+
+@pytest.mark.parametrize('batch_size', [1, 3])
+@pytest.mark.parametrize('dtype', [torch.float32, torch.uint8])
+def test_tiled_predict_reassembles_pointwise_predictions(batch_size, dtype):
+    #a pixelwise network gives the same prediction tiled or not
+    images = torch.rand(3, 3, 150, 130)
+    predict = lambda tiles: torch.softmax(tiles[:, :2] * 4, dim = 1)
+    buffers = {}
+    def acquire(index):
+        if index not in buffers:
+            buffers[index] = torch.zeros((2, 150, 130), dtype = dtype)
+        return buffers[index]
+    loader = [(images[:2], ['a', 'b']), (images[2:], ['c'])]
+    done = list(tiled_predict(loader, predict, (150, 130), (64, 64), acquire, 0.25, 'gaussian', batch_size))
+    assert done == [(0, 'a'), (1, 'b'), (2, 'c')]
+    expected = predict(images)
+    for i in range(3):
+        if dtype == torch.uint8:
+            assert (buffers[i].float() / 255 - expected[i]).abs().max() <= 1 / 255
+        else:
+            assert torch.allclose(buffers[i], expected[i], atol = 1e-5)
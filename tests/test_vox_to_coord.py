@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the chunked voxel projection (romiseg.utils.vox_to_coord).
+"""
+
+import pytest
+import torch
+
+from romiseg.utils import vox_to_coord as vtc
+
+
+N_CAM, XINIT, YINIT, SX, SY = 5, 64, 48, 60, 40
+
+
+@pytest.fixture
+def scene():
+    """Voxel grid seen by cameras placed in front of it, part of the voxels project outside the images"""
+    torch.manual_seed(0)
+    extrinsics = torch.zeros(N_CAM, 3, 4)
+    for i in range(N_CAM):
+        q = torch.linalg.qr(torch.eye(3) + 0.3 * torch.randn(3, 3))[0]
+        extrinsics[i, :, :3] = q * torch.sign(torch.det(q))
+        extrinsics[i, :, 3] = torch.tensor([0., 0., 60.])
+    intrinsics = vtc.get_int(50., 50., XINIT / 2, YINIT / 2)
+    voxels = torch.from_numpy(vtc.basis_vox_pipeline([-20, -20, -10], [20, 20, 30], 11, 9, 7))
+    return voxels, intrinsics, extrinsics, torch.Size([N_CAM, XINIT, YINIT, 3])
+
+
+def unchunked(voxels, intrinsics, extrinsics, shape):
+    xy_coords = vtc.project_coordinates(voxels, intrinsics, extrinsics, give_prod = False)
+    xy_coords[:, 2, :] = xy_coords[:, 0, :]
+    xy_coords[:, 0, :] = xy_coords[:, 1, :]
+    xy_coords[:, 1, :] = xy_coords[:, 2, :]
+    coords = vtc.correct_coords_outside(xy_coords, SX, SY, XINIT, YINIT, -1)
+    return vtc.flatten_coordinates(coords, shape)
+
+
+@pytest.mark.parametrize('n_vox, chunk_size', [(10, 3), (10, 10), (10, 100), (0, 4), (7, 1)])
+def test_voxel_chunks_partition_the_voxels(n_vox, chunk_size):
+    chunks = list(vtc.voxel_chunks(n_vox, chunk_size))
+    covered = [i for chunk in chunks for i in range(n_vox)[chunk]]
+    assert covered == list(range(n_vox))
+    assert all(0 < chunk.stop - chunk.start <= chunk_size for chunk in chunks)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 17, 100, 10**6, None])
+def test_chunked_projection_equals_unchunked(scene, chunk_size):
+    voxels, intrinsics, extrinsics, shape = scene
+    expected = unchunked(voxels, intrinsics, extrinsics, shape)
+    assert (expected == -1).any() and (expected >= 0).any()
+    flat = vtc.project_flat_coordinates(voxels, intrinsics, extrinsics, shape, SX, SY, XINIT, YINIT,
+                                        chunk_size = chunk_size)
+    assert flat.dtype == torch.long
+    assert torch.equal(flat, expected)
+
+
+def test_projection_writes_into_out(scene):
+    voxels, intrinsics, extrinsics, shape = scene
+    out = torch.full((N_CAM * len(voxels),), 7, dtype = torch.long)
+    flat = vtc.project_flat_coordinates(voxels, intrinsics, extrinsics, shape, SX, SY, XINIT, YINIT,
+                                        chunk_size = 50, out = out)
+    assert flat is out
+    assert torch.equal(out, unchunked(voxels, intrinsics, extrinsics, shape))
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the weights lookup (romiseg.utils.weights_store.resolve), the server
+being replaced by a stand-in of requests.get.
+"""
+
+import hashlib
+import json
+
+import pytest
+import requests
+
+from romiseg.utils import weights_store
+
+
+WEIGHTS = b'weights' * 1000
+
+
+class Response(object):
+    def __init__(self, status, content = b''):
+        self.status_code = status
+        self.ok = status < 400
+        self.content = content
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise requests.HTTPError('%d' % self.status_code)
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+
+@pytest.fixture
+def server(monkeypatch):
+    """Files served by url suffix, records the requested urls and their timeout"""
+    files = {}
+    requested = []
+    def get(url, stream = False, timeout = None):
+        requested.append((url, timeout))
+        for name, content in files.items():
+            if url.endswith('/' + name):
+                if isinstance(content, Exception):
+                    raise content
+                return Response(200, content)
+        return Response(404)
+    monkeypatch.setattr(requests, 'get', get)
+    monkeypatch.delenv('ROMISEG_OFFLINE', raising = False)
+    monkeypatch.delenv('ROMISEG_WEIGHTS_MIRROR', raising = False)
+    return files, requested
+
+
+def test_local_copy_first(server, tmp_path):
+    files, requested = server
+    (tmp_path / 'model.pt').write_bytes(WEIGHTS)
+    assert weights_store.resolve(str(tmp_path), 'model.pt') == str(tmp_path / 'model.pt')
+    assert requested == []
+
+
+def test_download_with_sidecar(server, tmp_path):
+    files, requested = server
+    files['model.pt'] = WEIGHTS
+    files['model.pt.json'] = json.dumps({'sha256': hashlib.sha256(WEIGHTS).hexdigest()}).encode()
+    path = weights_store.resolve(str(tmp_path), 'model.pt')
+    assert open(path, 'rb').read() == WEIGHTS and weights_store.is_state_dict(path)
+    assert all(timeout == weights_store.TIMEOUT for _, timeout in requested)
+
+
+def test_download_without_sidecar(server, tmp_path):
+    files, requested = server
+    files['model.pt'] = WEIGHTS
+    path = weights_store.resolve(str(tmp_path), 'model.pt')
+    assert open(path, 'rb').read() == WEIGHTS and not weights_store.is_state_dict(path)
+
+
+@pytest.mark.parametrize('failure', [requests.ConnectTimeout('timed out'), requests.ConnectionError('refused')])
+def test_unreachable_server(server, tmp_path, failure):
+    files, requested = server
+    files['model.pt.json'] = failure
+    files['model.pt'] = failure
+    with pytest.raises(FileNotFoundError):
+        weights_store.resolve(str(tmp_path), 'model.pt')
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_corrupted_download(server, tmp_path):
+    files, requested = server
+    files['model.pt'] = WEIGHTS[:-1]
+    files['model.pt.json'] = json.dumps({'sha256': hashlib.sha256(WEIGHTS).hexdigest()}).encode()
+    with pytest.raises(ValueError):
+        weights_store.resolve(str(tmp_path), 'model.pt')
+    #neither the weights nor their sidecar are left behind
+    assert list(tmp_path.iterdir()) == []